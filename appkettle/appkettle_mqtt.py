@@ -4,6 +4,19 @@
 usage: appkettle_mqtt.py [-h]
                          [--mqtt host port username password]
                          [--calibrate lvl_min lvl_max]
+                         [--auto-calibrate | --no-auto-calibrate]
+                         [--capacity-ml CAPACITY_ML]
+                         [--data-dir DATA_DIR]
+                         [--debug-level {0,1,2}]
+                         [--control-socket CONTROL_SOCKET]
+                         [--config CONFIG]
+                         [--proxy-port PROXY_PORT]
+                         [--history-days HISTORY_DAYS]
+                         [--api-port API_PORT]
+                         [--subnet SUBNET]
+                         [--ha-url HA_URL] [--ha-token HA_TOKEN]
+                         [--scan CIDR]
+                         [--ctl COMMAND]
                          [--port PORT]
                          [host] [imei]
 
@@ -17,392 +30,121 @@ optional arguments:
                     MQTT broker host, port, username & password (e.g. --mqtt 192.168.0.1 1883 mqtt_user p@55w0Rd)
   --calibrate lvl_min lvl_max
                     Min and max volume values for the kettle water level sensor (e.g. --calibrate 160 1640)
+  --auto-calibrate, --no-auto-calibrate
+                    learn the min and max volume values while the kettle sits on its base (default on)
+  --capacity-ml CAPACITY_ML
+                    water in the kettle at its max mark, for the water amount in mL (default 1700)
+  --data-dir DATA_DIR
+                    directory used to persist learned values (default: current directory)
+  --debug-level {0,1,2}
+                    0: quiet, 1: log commands, 2: also log heartbeats and KeepConnect (default 1)
+  --control-socket CONTROL_SOCKET
+                    path of the control socket (default: appkettle.sock in the data directory)
+  --config CONFIG   add-on options JSON file, re-read on SIGHUP (e.g. /data/options.json)
+  --proxy-port PROXY_PORT
+                    share the kettle session with other apps connecting to this port (default off)
+  --history-days HISTORY_DAYS
+                    days of heartbeats kept in memory for the hist commands, 0 to disable (default 7)
+  --api-port API_PORT
+                    serve the local HTTP API (REST and Server-Sent Events) on this port (default off)
+  --subnet SUBNET   find the kettle by probing every address of this subnet (e.g. 192.168.0.0/24)
+                    instead of broadcasting
+  --ha-url HA_URL   also push the status straight to Home Assistant's API at this URL
+                    (e.g. http://supervisor/core in an add-on, or http://homeassistant.local:8123)
+  --ha-token HA_TOKEN
+                    Home Assistant long-lived access token (default: $SUPERVISOR_TOKEN)
+  --scan CIDR       probe every address of this subnet, print the kettles found (JSON) and exit
+  --ctl COMMAND     send a command (e.g. "on 80", "s", "reload") to the running daemon and exit
   --port PORT       kettle port (default 6002)
 
+Control socket commands (one per line, one reply line each):
+  on [temp]         turn the kettle on, optionally at temp
+  off / wake        turn the kettle off / wake it up
+  s / ss / fs       print status / full status / frame decoding stats
+  k                 send a KeepConnect
+  sl:<raw>          send raw bytes
+  sm:<data2>        send a data2 message
+  reload            re-read the --config file, same as SIGHUP
+  lat               command latency histograms per stage (JSON)
+  hist [secs [step]]
+                    heartbeats from the last secs (default 3600) as JSON, one per step seconds
+                    (step is raised to return 2000 rows at most)
+  histexport <path> [secs]
+                    save heartbeats to a .csv or .npy (needs numpy) file
+
 Notes:
 - If you supply a host IP but omit IMEI, the script will unicast-probe that IP to fetch the IMEI.
-- If you supply neither host nor IMEI, the script will attempt broadcast discovery.
+- If you supply neither host nor IMEI, the script will sweep --subnet if given, or attempt broadcast
+  discovery.
 - Be sure to block the kettle’s internet access to force local mode.
+- The --calibrate values are used until enough readings have been seen to auto-calibrate.
 """
 
-import sys
 import time
-import socket
-import select
+STARTUP_T0 = time.monotonic()  # taken before the other imports for the startup timeline
+
+import sys
 import signal
+import os
+import asyncio
 import json
 import argparse
+import ipaddress
 from functools import partial
 
 # Flush prints so logs show up immediately in HA
 print = partial(print, flush=True)
 
-import paho.mqtt.client as mqtt     # pip install paho-mqtt
-from Cryptodome.Cipher import AES   # pip install pycryptodomex
-
-from protocol_parser import unpack_msg, calc_msg_checksum
+from kettle_client import (
+    KettleClient, KettleEvents, KettleProxy, KettleSocket, KettleUsage, LevelCalibration, EVENTS,
+    LVL_CALIB_DEFAULT, KETTLE_CAPACITY_ML, CALIBRATION_FILE, USAGE_FILE
+)
+from kettle_history import KettleHistory, HISTORY_COLUMNS, HISTORY_DAYS_DEFAULT
+from kettle_api import KettleApi
+from kettle_trace import LatencyTracer
+from kettle_backends import OutputBackend, HomeAssistantBackend
 
-DEBUG_MSG = True
-DEBUG_PRINT_STAT_MSG = False
-DEBUG_PRINT_KEEP_CONNECT = False
+DEBUG_LEVEL = 1  # see apply_debug_level
 SEND_ENCRYPTED = False
-MSGLEN = 3200
 
-KETTLE_SOCKET_CONNECT_ATTEMPTS = 3
-KETTLE_SOCKET_TIMEOUT_SECS = 60
-KEEP_WARM_MINS = 10
-
-ENCRYPT_HEADER = bytes([0x23, 0x23, 0x38, 0x30])
-PLAIN_HEADER   = bytes([0x23, 0x23, 0x30, 0x30])
-MSG_KEEP_CONNECT = b"##000bKeepConnect&&"
-MSG_KEEP_CONNECT_FREQ_SECS = 30
-UDP_IP_BCAST_DEFAULT = "255.255.255.255"
-UDP_PORT = 15103
+DISCOVERY_CACHE_FILE = "appkettle_discovery.json"
+CONTROL_SOCKET_FILE = "appkettle.sock"
+STARTUP_TARGET_SECS = 1.0  # first status published, when discovery is cached
+STARTUP_MARKS = {}
 
 MQTT_BASE = "appKettle/"
 MQTT_COMMAND_TOPIC = MQTT_BASE + "command"
 MQTT_STATUS_TOPIC = MQTT_BASE + "status"
 MQTT_AVAILABILITY_TOPIC = MQTT_BASE + "state"
+MQTT_EVENT_TOPIC = MQTT_BASE + "event"
+MQTT_LATENCY_TOPIC = MQTT_BASE + "latency"
 MQTT_DEVICE_ID = "appKettle"
 MQTT_SWITCH_DISC_TOPIC = "homeassistant/switch/" + MQTT_DEVICE_ID
 MQTT_SENSOR_DISC_TOPIC = "homeassistant/sensor/" + MQTT_DEVICE_ID
 MQTT_NUMBER_DISC_TOPIC = "homeassistant/number/" + MQTT_DEVICE_ID
+MQTT_TRIGGER_DISC_TOPIC = "homeassistant/device_automation/" + MQTT_DEVICE_ID
 MQTT_DEVICE_NAME = "appKettle"
 MQTT_DEVICE_MANUFACTURER = "appKettle"
 MQTT_DEVICE_MODEL = "appKettle"
+MQTT_MAX_QUEUED_MESSAGES = 100  # QoS>0 messages held by paho while the broker is away
 
-# AES secrets:
-SECRET_KEY = b"ay3$&dw*ndAD!9)<"
-SECRET_IV  = b"7e3*WwI(@Dczxcue"
-
-class AppKettle:
-    """Represents a physical appKettle"""
-
-    def __init__(self, sock=None):
-        self.sock = sock
-        self.stat = {
-            "cmd": "unk",
-            "status": "unk",
-            "keep_warm_secs": 0,
-            "keep_warm_onoff": False,
-            "temperature": 0,
-            "target_temp": 0,
-            "set_target_temp": 100,
-            "volume": 0,
-            "power": "OFF",
-            "seq": 0,
-        }
-
-    def tick(self):
-        self.stat["seq"] = (self.stat["seq"] + 1) % 0xFF
-
-    def turn_on(self, temp=None):
-        if self.stat["status"] != "Ready":
-            self.wake()
-        self.tick()
-        if temp is None:
-            temp = self.stat["set_target_temp"]
-        msg = "AA001200000000000003B7{seq}39000000{temp}{kw}0000".format(
-            temp=("%0.2X" % temp),
-            kw=("%0.2X" % (KEEP_WARM_MINS * self.stat["keep_warm_onoff"])),
-            seq=("%0.2x" % self.stat["seq"]),
-        )
-        msg = calc_msg_checksum(msg, append=True)
-        return self.sock.send_enc(msg, SEND_ENCRYPTED)
-
-    def wake(self):
-        self.tick()
-        msg = "AA000D00000000000003B7{seq}410000".format(seq=("%0.2x" % self.stat["seq"]))
-        msg = calc_msg_checksum(msg, append=True)
-        return self.sock.send_enc(msg, SEND_ENCRYPTED)
-
-    def turn_off(self):
-        self.tick()
-        msg = "AA000D00000000000003B7{seq}3A0000".format(seq=("%0.2x" % self.stat["seq"]))
-        msg = calc_msg_checksum(msg, append=True)
-        return self.sock.send_enc(msg)
-
-    def status_json(self):
-        keys = {"power", "status", "temperature", "target_temp", "volume", "keep_warm_secs"}
-        status_dict = {k: self.stat[k] for k in self.stat.keys() & keys}
-        return json.dumps(status_dict)
-
-    def update_status(self, msg):
-        """Parses a wifi_cmd message to match this class status with the physical kettle"""
-        try:
-            cmd_dict = unpack_msg(
-                msg, DEBUG_MSG, DEBUG_PRINT_STAT_MSG, DEBUG_PRINT_KEEP_CONNECT
-            )
-        except ValueError:
-            print("Error in decoding: ", msg)
-            return
-    
-        if not isinstance(cmd_dict, dict):
-            # nothing useful
-            return
-    
-        # If unpack_msg already gave us flattened status keys, merge them
-        # (typical keys seen: cmd, status, temperature, target_temp, volume, power, keep_warm_secs, etc.)
-        known_keys = {
-            "cmd", "status", "temperature", "target_temp", "set_target_temp",
-            "volume", "power", "keep_warm_secs", "keep_warm_onoff", "version"
-        }
-        if known_keys & cmd_dict.keys():
-            for k in known_keys:
-                if k in cmd_dict:
-                    self.stat[k] = cmd_dict[k]
-            return
-    
-        # Legacy path: some decoders nest under data3 (keep for compatibility)
-        if "data3" in cmd_dict and isinstance(cmd_dict["data3"], dict):
-            for k in known_keys:
-                if k in cmd_dict["data3"]:
-                    self.stat[k] = cmd_dict["data3"][k]
-            return
-    
-        # Messages we sent (debug traffic) or other frames we don't care about
-        if "data2" in cmd_dict:
-            return
-    
-        print("Unparsed Json message: ", cmd_dict)
-  
-
-class KettleSocket:
-    """Handles connection, encryption and decryption for an AppKettle"""
-
-    def __init__(self, sock=None, imei="", broadcast_ip=UDP_IP_BCAST_DEFAULT):
-        if sock is None:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.settimeout(KETTLE_SOCKET_TIMEOUT_SECS)
-        else:
-            self.sock = sock
-        self.connected = False
-        self.imei = imei
-        self.stat = ""
-        self.broadcast_ip = broadcast_ip
-
-    def connect(self, host_port):
-        attempts = KETTLE_SOCKET_CONNECT_ATTEMPTS
-        print("Attempting to connect to socket...")
-        while attempts and not self.connected:
-            try:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.settimeout(KETTLE_SOCKET_TIMEOUT_SECS)
-                self.sock.connect(host_port)
-                self.keep_connect()
-                self.connected = True
-                return
-            except (TimeoutError, OSError) as err:
-                print("Socket error:", err, "|", attempts, "attempts remaining")
-                attempts -= 1
-                self.connected = False
-        print("Socket timeout")
-        self.connected = False
-
-    # ---------- Discovery helpers ----------
-    def _parse_probe_reply(self, payload, address):
-        parts = payload.split("#")
-        if len(parts) < 7:
-            print("[DISCOVERY] Unexpected reply format")
-            return None
-        msg_json = json.loads(parts[6])
-        msg_json.update({"imei": parts[0], "version": parts[3], "kettleIP": address[0]})
-        return msg_json
-
-    def kettle_probe_unicast(self, ip, timeout=5):
-        """Send a unicast probe to a known IP and parse reply to get IMEI & info."""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            sock.bind(("", UDP_PORT))
-        except OSError as e:
-            print(f"[DISCOVERY] bind(UDP {UDP_PORT}) failed:", e)
-            sock.close()
-            return None
-
-        # Required "-2" suffix in probe
-        prb = time.strftime("Probe#%Y-%m-%d-%H-%M-%S-2", time.localtime())
-        print(f"[DISCOVERY] Sending unicast probe to {ip}: {prb}")
-        sock.sendto(prb.encode("ascii"), (ip, UDP_PORT))
-
-        sock.settimeout(timeout)
-        try:
-            data, address = sock.recvfrom(1024)
-        except socket.timeout:
-            print(f"[DISCOVERY] No reply from {ip} within {timeout}s")
-            sock.close()
-            return None
-        payload = data.decode("ascii", errors="replace")
-        print(f"[DISCOVERY] Got reply from {address}: {payload}")
-        sock.close()
-
-        info = self._parse_probe_reply(payload, address)
-        if info:
-            print(f"[DISCOVERY] Unicast success: IP={info.get('kettleIP')} IMEI={info.get('imei')}")
-            self.stat = info
-        return info
-
-    def kettle_probe(self, attempts=5, timeout=5):
-        """Broadcast probe (L2) to discover kettle and return info dict."""
-        for attempt in range(1, attempts + 1):
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                try:
-                    sock.bind(("", UDP_PORT))  # single socket for send/recv
-                except OSError as e:
-                    print(f"[DISCOVERY] bind(UDP {UDP_PORT}) failed:", e)
-                    sock.close()
-                    break
-
-                print(f"[DISCOVERY] Broadcast attempt {attempt}/{attempts} bcast={self.broadcast_ip}")
-                # Send several probes with "-2" suffix
-                for _ in range(4):
-                    prb = time.strftime("Probe#%Y-%m-%d-%H-%M-%S-2", time.localtime())
-                    sock.sendto(prb.encode("ascii"), (self.broadcast_ip, UDP_PORT))
-                    print(f"[DISCOVERY] Sent probe: {prb}")
-
-                sock.settimeout(timeout)
-                try:
-                    data, address = sock.recvfrom(1024)
-                except socket.timeout:
-                    print(f"[DISCOVERY] Timeout after {timeout}s waiting for reply")
-                    sock.close()
-                    continue
-
-                payload = data.decode("ascii", errors="replace")
-                print(f"[DISCOVERY] Got reply from {address}: {payload}")
-                sock.close()
-
-                info = self._parse_probe_reply(payload, address)
-                if info:
-                    print("[DISCOVERY] Broadcast success")
-                    self.stat = info
-                    return info
-            except Exception as e:
-                print(f"[DISCOVERY] Broadcast error: {e}")
-
-        print(f"[DISCOVERY] No response after {attempts} attempts")
-        return None
-    # ---------- end discovery helpers ----------
-
-    def keep_connect(self):
-        if DEBUG_PRINT_KEEP_CONNECT:
-            print("A: KeepConnect")
-        try:
-            self.sock.sendall(MSG_KEEP_CONNECT)
-        except OSError as err:
-            print("Socket error (keep connect):", err)
-            self.connected = False
-
-    def close(self):
-        print("Closing socket...")
-        self.sock.close()
-
-    def send(self, msg):
-        try:
-            sent = self.sock.sendall(msg)
-        except OSError as err:
-            print("Socket error (send):", err)
-            self.connected = False
-            return
-        if sent is not None:
-            self.connected = False
-            raise RuntimeError("Socket connection broken")
-
-    def receive(self):
-        chunks = []
-        bytes_recd = 0
-        while bytes_recd < MSGLEN and chunks[-2:] != [b"&", b"&"] and self.connected:
-            try:
-                chunk = self.sock.recv(1)
-                chunks.append(chunk)
-                bytes_recd += len(chunk)
-            except socket.error:
-                print("Socket connection broken?")
-                self.connected = False
-                return None
-            if chunk == b"":
-                print("Socket connection broken / no data")
-                self.connected = False
-                return None
-
-        frame = b"".join(chunks).partition(b"##")
-        frame = frame[1] + frame[2]
-
-        if frame[:4] == ENCRYPT_HEADER:
-            res = self.decrypt(frame[6:-2])
-        elif frame[:4] == PLAIN_HEADER:
-            res = frame[6:-2]
-        else:
-            res = frame
-            if len(frame) > 0:
-                print("Response not recognised", frame)
-
-        try:
-            res = res.decode("ascii")
-            return to_json(res.rstrip("\x00"))
-        except UnicodeDecodeError:
-            return None
-
-    @staticmethod
-    def decrypt(ciphertext):
-        try:
-            cipher_spec = AES.new(SECRET_KEY, AES.MODE_CBC, SECRET_IV)
-            return cipher_spec.decrypt(ciphertext)
-        except ValueError:
-            print("Not 16-byte boundary data")
-            return ciphertext
-        except Exception:
-            print("Unexpected error:", sys.exc_info()[0])
-            raise
-
-    @staticmethod
-    def pad(data_to_pad, block):
-        extra = len(data_to_pad) % block
-        if extra > 0:
-            return data_to_pad + (b"\x00" * (block - extra))
-        return data_to_pad
-
-    def encrypt(self, plaintext):
-        try:
-            cipher_spec = AES.new(SECRET_KEY, AES.MODE_CBC, SECRET_IV)
-            return cipher_spec.encrypt(self.pad(plaintext, AES.block_size))
-        except ValueError:
-            print("Not 16-byte boundary data:", plaintext)
-            return plaintext
-        except Exception:
-            print("Unexpected error:", sys.exc_info()[0])
-            raise
-
-    def send_enc(self, data2, encrypt=False):
-        msg = '{{"app_cmd":"62","imei":"{imei}","SubDev":"","data2":"{data2}"}}'.format(
-            imei=self.imei, data2=data2
-        )
-        if encrypt:
-            content = self.encrypt(msg.encode())
-            header = ENCRYPT_HEADER
-        else:
-            content = msg.encode()
-            header = PLAIN_HEADER
-        encoded_msg = header + bytes("%0.2X" % len(content), "utf-8") + content + b"&&"
-        self.send(encoded_msg)
-        if DEBUG_MSG:
-            unpack_msg(to_json(msg))
-
-def cb_mqtt_on_connect(client, kettle, flags, rec_code):
+def cb_mqtt_on_connect(client, kettle_client, flags, rec_code):
     print("Connected to MQTT broker with result code " + str(rec_code))
     client.subscribe(MQTT_COMMAND_TOPIC + "/#")
 
-def cb_mqtt_on_message(mqttc, kettle, msg):
+def cb_mqtt_on_message(mqttc, kettle_client, msg):
+    """Runs on the paho thread: kettle commands are handed over to the event loop"""
     print("MQTT MSG: " + msg.topic + " : " + str(msg.payload))
-    kettle.wake()
+    kettle = kettle_client.kettle
+    tracer = kettle_client.tracer
+    kettle_client.submit(kettle_client.wake(timeout=None))
     if msg.topic == MQTT_COMMAND_TOPIC + "/power":
         if msg.payload == b"ON":
-            kettle.turn_on()
+            trace = tracer.start("on", "mqtt") if tracer is not None else None
+            kettle_client.submit(kettle_client.turn_on(trace=trace))
         elif msg.payload == b"OFF":
-            kettle.turn_off()
+            trace = tracer.start("off", "mqtt") if tracer is not None else None
+            kettle_client.submit(kettle_client.turn_off(trace=trace))
         else:
             print("MQTT MSG: msg not recognised:", msg)
         mqttc.publish(MQTT_STATUS_TOPIC + "/power", kettle.stat["power"])
@@ -418,60 +160,31 @@ def cb_mqtt_on_message(mqttc, kettle, msg):
         kettle.stat["set_target_temp"] = int(msg.payload)
         mqttc.publish(MQTT_STATUS_TOPIC + "/set_target_temp", kettle.stat["set_target_temp"])
 
-def to_json(myjson):
-    try:
-        json_object = json.loads(myjson)
-    except (ValueError, TypeError):
-        return myjson
-    return json_object
-
-def main_loop(host_port, imei, mqtt_broker, lvl_calib=None):
-    """Main event loop called from __main__"""
-    # calibration defaults
-    if not lvl_calib:
-        lvl_calib = [160, 1640]
-    else:
-        lvl_calib = [int(lvl_calib[0]), int(lvl_calib[1])]
-    print("Calibration:", lvl_calib)
+class MqttBridge(OutputBackend):
+    """Publishes the kettle status to MQTT and hands MQTT commands to the kettle client
 
-    kettle_socket = KettleSocket(imei=imei or "")
-    kettle = AppKettle(kettle_socket)
+    broker is (host, port, username, password), or None to run without MQTT
+    """
 
-    # Discovery rules:
-    # - If host provided but imei missing: unicast probe that host to fetch IMEI/info
-    # - If neither provided: broadcast discovery
-    if host_port[0] and not imei:
-        print("[DISCOVERY] Known host provided, discovering IMEI via unicast…")
-        info = kettle_socket.kettle_probe_unicast(host_port[0])
-        if not info:
-            print("Discovery (unicast) failed. Exiting.")
-            sys.exit(1)
-        imei = info["imei"]
-        kettle_socket.imei = imei
-        kettle.stat.update(info)
-    elif not host_port[0]:
-        print("[DISCOVERY] No host provided, attempting broadcast discovery…")
-        info = kettle_socket.kettle_probe()
-        if not info:
-            print("Discovery (broadcast) failed and no host provided. Exiting.")
-            sys.exit(1)
-        host_port = (info["kettleIP"], host_port[1])
-        imei = info["imei"]
-        kettle_socket.imei = imei
-        kettle.stat.update(info)
-    else:
-        print("[DISCOVERY] Host and IMEI provided; skipping discovery.")
+    def __init__(self, kettle_client, broker=None):
+        self.kettle_client = kettle_client
+        self.broker = broker
+        self.mqttc = None
 
-    mqttc = None
-    if mqtt_broker is not None:
+    def connect(self):
+        """Connects to the broker and announces the HA entities (blocking)"""
+        if self.broker is None:
+            return
+        import paho.mqtt.client as mqtt     # pip install paho-mqtt
         mqttc = mqtt.Client()
-        if mqtt_broker[2] is not None:
-            mqttc.username_pw_set(mqtt_broker[2], password=mqtt_broker[3])
+        if self.broker[2] is not None:
+            mqttc.username_pw_set(self.broker[2], password=self.broker[3])
         mqttc.on_connect = cb_mqtt_on_connect
         mqttc.on_message = cb_mqtt_on_message
-        mqttc.user_data_set(kettle)
+        mqttc.user_data_set(self.kettle_client)
+        mqttc.max_queued_messages_set(MQTT_MAX_QUEUED_MESSAGES)
         mqttc.will_set(MQTT_AVAILABILITY_TOPIC, "offline", retain=True)
-        mqttc.connect(mqtt_broker[0], int(mqtt_broker[1]))
+        mqttc.connect(self.broker[0], int(self.broker[1]))
         mqttc.publish(MQTT_AVAILABILITY_TOPIC, "online", retain=True)
 
         # Home Assistant discovery entities
@@ -565,11 +278,28 @@ def main_loop(host_port, imei, mqtt_broker, lvl_calib=None):
                     "name": MQTT_DEVICE_NAME
                 },
                 "name": "Kettle Fill Level",
-                "state_topic": MQTT_STATUS_TOPIC + "/STATE",
+                "state_topic": MQTT_STATUS_TOPIC + "/fill_level",
                 "unique_id": "kettle_fill_level",
                 "unit_of_measurement": "%",
-                "icon": "mdi:cup-water",
-                "value_template": "{{ (min(100, max(0, (((value_json.volume - " + str(lvl_calib[0]) + ") / (" + str(lvl_calib[1]) + " - " + str(lvl_calib[0]) + ")) * 100)|round(0)))) }}"
+                "icon": "mdi:cup-water"
+            }),
+            retain=True
+        )
+        mqttc.publish(
+            MQTT_SENSOR_DISC_TOPIC + "/fill_ml/config",
+            json.dumps({
+                "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}],
+                "device": {
+                    "identifiers": MQTT_DEVICE_NAME,
+                    "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                    "model": MQTT_DEVICE_MODEL,
+                    "name": MQTT_DEVICE_NAME
+                },
+                "name": "Kettle Water Amount",
+                "state_topic": MQTT_STATUS_TOPIC + "/fill_ml",
+                "unique_id": "kettle_fill_ml",
+                "unit_of_measurement": "mL",
+                "icon": "mdi:water"
             }),
             retain=True
         )
@@ -608,93 +338,616 @@ def main_loop(host_port, imei, mqtt_broker, lvl_calib=None):
             retain=True
         )
 
+        mqttc.publish(
+            MQTT_SENSOR_DISC_TOPIC + "/energy_kwh/config",
+            json.dumps({
+                "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}],
+                "device": {
+                    "identifiers": MQTT_DEVICE_NAME,
+                    "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                    "model": MQTT_DEVICE_MODEL,
+                    "name": MQTT_DEVICE_NAME
+                },
+                "name": "Kettle Energy",
+                "state_topic": MQTT_STATUS_TOPIC + "/energy_kwh",
+                "unique_id": "kettle_energy_kwh",
+                "device_class": "energy",
+                "state_class": "total_increasing",
+                "unit_of_measurement": "kWh",
+                "icon": "mdi:lightning-bolt"
+            }),
+            retain=True
+        )
+        mqttc.publish(
+            MQTT_SENSOR_DISC_TOPIC + "/last_boil_kwh/config",
+            json.dumps({
+                "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}],
+                "device": {
+                    "identifiers": MQTT_DEVICE_NAME,
+                    "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                    "model": MQTT_DEVICE_MODEL,
+                    "name": MQTT_DEVICE_NAME
+                },
+                "name": "Kettle Last Boil Energy",
+                "state_topic": MQTT_STATUS_TOPIC + "/last_boil_kwh",
+                "unique_id": "kettle_last_boil_kwh",
+                "state_class": "measurement",
+                "unit_of_measurement": "kWh",
+                "icon": "mdi:lightning-bolt-outline"
+            }),
+            retain=True
+        )
+        mqttc.publish(
+            MQTT_SENSOR_DISC_TOPIC + "/boil_count/config",
+            json.dumps({
+                "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}],
+                "device": {
+                    "identifiers": MQTT_DEVICE_NAME,
+                    "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                    "model": MQTT_DEVICE_MODEL,
+                    "name": MQTT_DEVICE_NAME
+                },
+                "name": "Kettle Boils",
+                "state_topic": MQTT_STATUS_TOPIC + "/boil_count",
+                "unique_id": "kettle_boil_count",
+                "state_class": "total_increasing",
+                "icon": "mdi:counter"
+            }),
+            retain=True
+        )
+        mqttc.publish(
+            MQTT_SENSOR_DISC_TOPIC + "/water_boiled_l/config",
+            json.dumps({
+                "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}],
+                "device": {
+                    "identifiers": MQTT_DEVICE_NAME,
+                    "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                    "model": MQTT_DEVICE_MODEL,
+                    "name": MQTT_DEVICE_NAME
+                },
+                "name": "Kettle Water Boiled",
+                "state_topic": MQTT_STATUS_TOPIC + "/water_boiled_l",
+                "unique_id": "kettle_water_boiled_l",
+                "device_class": "water",
+                "state_class": "total_increasing",
+                "unit_of_measurement": "L",
+                "icon": "mdi:water-boiler"
+            }),
+            retain=True
+        )
+
+        mqttc.publish(
+            MQTT_SENSOR_DISC_TOPIC + "/ack_latency/config",
+            json.dumps({
+                "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}],
+                "device": {
+                    "identifiers": MQTT_DEVICE_NAME,
+                    "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                    "model": MQTT_DEVICE_MODEL,
+                    "name": MQTT_DEVICE_NAME
+                },
+                "name": "Kettle Ack Latency",
+                "state_topic": MQTT_LATENCY_TOPIC,
+                "value_template": "{{ value_json.acked.last }}",
+                "json_attributes_topic": MQTT_LATENCY_TOPIC,
+                "unique_id": "kettle_ack_latency",
+                "entity_category": "diagnostic",
+                "state_class": "measurement",
+                "unit_of_measurement": "ms",
+                "icon": "mdi:timer-outline"
+            }),
+            retain=True
+        )
+
+        mqttc.publish(
+            MQTT_SENSOR_DISC_TOPIC + "/link_rtt_ms/config",
+            json.dumps({
+                "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}],
+                "device": {
+                    "identifiers": MQTT_DEVICE_NAME,
+                    "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                    "model": MQTT_DEVICE_MODEL,
+                    "name": MQTT_DEVICE_NAME
+                },
+                "name": "Kettle Link RTT",
+                "state_topic": MQTT_STATUS_TOPIC + "/link_rtt_ms",
+                "unique_id": "kettle_link_rtt_ms",
+                "entity_category": "diagnostic",
+                "state_class": "measurement",
+                "unit_of_measurement": "ms",
+                "icon": "mdi:lan-pending"
+            }),
+            retain=True
+        )
+        mqttc.publish(
+            MQTT_SENSOR_DISC_TOPIC + "/heartbeat_jitter_ms/config",
+            json.dumps({
+                "availability": [{"topic": MQTT_AVAILABILITY_TOPIC}],
+                "device": {
+                    "identifiers": MQTT_DEVICE_NAME,
+                    "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                    "model": MQTT_DEVICE_MODEL,
+                    "name": MQTT_DEVICE_NAME
+                },
+                "name": "Kettle Heartbeat Jitter",
+                "state_topic": MQTT_STATUS_TOPIC + "/heartbeat_jitter_ms",
+                "unique_id": "kettle_heartbeat_jitter_ms",
+                "entity_category": "diagnostic",
+                "state_class": "measurement",
+                "unit_of_measurement": "ms",
+                "icon": "mdi:pulse"
+            }),
+            retain=True
+        )
+
+        # Device triggers, so automations can react to kettle events
+        for event in EVENTS:
+            mqttc.publish(
+                MQTT_TRIGGER_DISC_TOPIC + "/" + event + "/config",
+                json.dumps({
+                    "automation_type": "trigger",
+                    "device": {
+                        "identifiers": MQTT_DEVICE_NAME,
+                        "manufacturer": MQTT_DEVICE_MANUFACTURER,
+                        "model": MQTT_DEVICE_MODEL,
+                        "name": MQTT_DEVICE_NAME
+                    },
+                    "topic": MQTT_EVENT_TOPIC,
+                    "payload": event,
+                    "type": event,
+                    "subtype": "kettle"
+                }),
+                retain=True
+            )
+
         mqttc.loop_start()
+        self.mqttc = mqttc
 
-    def cb_signal_handler(sig, frame):
-        user_input = input("prompt|>> ")
-        if user_input == "q":
-            kettle.sock.close()
-            sys.exit(0)
+    def close(self):
+        if self.mqttc is None:
             return
-        if user_input == "":
+        print("Disconnecting from MQTT broker...")
+        self.mqttc.publish(MQTT_AVAILABILITY_TOPIC, "offline", retain=True)
+        self.mqttc.loop_stop()
+        self.mqttc.disconnect()
+        self.mqttc = None
+
+    async def reload(self, options):
+        """Reconnects if the broker settings changed"""
+        broker = options_broker(options)
+        if broker == self.broker:
             return
-        params = user_input.split()
-        if user_input[:2] == "on":
-            if len(params) == 1:
-                kettle.turn_on()
-            elif len(params) == 2:
-                kettle.turn_on(int(params[1]))
-        elif user_input == "off":
-            kettle.turn_off()
-        elif user_input == "wake":
-            kettle.wake()
-        elif user_input == "s":
-            print("s: ", kettle.status_json())
-        elif user_input == "ss":
-            print("ss: ", kettle.stat)
-        elif user_input[:3] == "k":
-            kettle_socket.keep_connect()
-        elif user_input[:3] == "sl:":
-            kettle.sock.send(bytes(user_input[3:].encode()))
-        elif user_input[:3] == "sm:":
-            kettle.sock.send_enc(user_input[3:], SEND_ENCRYPTED)
-        else:
-            print("Input not recognised:", user_input)
+        print("[RELOAD] MQTT settings changed, reconnecting to broker")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.close)
+        self.broker = broker
+        try:
+            await loop.run_in_executor(None, self.connect)
+        except OSError as err:
+            print("[RELOAD] Could not connect to MQTT broker:", err)
+
+    def connected(self):
+        """True if status updates can be published. While the broker is away they are dropped
+        rather than piling up in paho's outgoing queue, the next heartbeat catches HA up
+        """
+        return self.mqttc is not None and self.mqttc.is_connected()
+
+    def publish_event(self, event):
+        if self.connected():
+            self.mqttc.publish(MQTT_EVENT_TOPIC, event)
+
+    def publish_latency(self, summary):
+        if self.connected():
+            self.mqttc.publish(MQTT_LATENCY_TOPIC, json.dumps(summary), retain=True)
 
-    signal.signal(signal.SIGINT, cb_signal_handler)
-    timestamp = time.time()
+    def publish_status(self, stat):
+        if not self.connected():
+            return
+        self.mqttc.publish(MQTT_STATUS_TOPIC + "/STATE", self.kettle_client.kettle.status_json())
+        for i in [
+            "temperature",
+            "target_temp",
+            "set_target_temp",
+            "status",
+            "power",
+            "version",
+            "keep_warm_secs",
+            "keep_warm_onoff",
+            "volume",
+            "fill_level",
+            "fill_ml",
+            "energy_kwh",
+            "last_boil_kwh",
+            "boil_count",
+            "water_boiled_l",
+            "link_rtt_ms",
+            "heartbeat_jitter_ms",
+        ]:
+            if stat.get(i) is not None:
+                self.mqttc.publish(MQTT_STATUS_TOPIC + "/" + i, stat[i])
+
+def startup_mark(stage):
+    """Records and prints how long after start a startup stage first completed"""
+    if stage in STARTUP_MARKS:
+        return
+    elapsed = time.monotonic() - STARTUP_T0
+    STARTUP_MARKS[stage] = elapsed
+    print("[STARTUP] {stage}: {elapsed:.3f}s".format(stage=stage, elapsed=elapsed))
+    if stage == "first status" and elapsed > STARTUP_TARGET_SECS:
+        print("[STARTUP] First status took longer than {target}s:".format(target=STARTUP_TARGET_SECS), STARTUP_MARKS)
 
-    if host_port[0] is None:
-        kettle.sock.close()
+def load_discovery_cache(path):
+    try:
+        with open(path, encoding="utf-8") as cache_file:
+            cached = json.load(cache_file)
+        return {"imei": str(cached["imei"]), "kettleIP": str(cached["kettleIP"])}
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        print("[DISCOVERY] Ignoring unreadable cache", path, "|", err)
+        return None
+
+def save_discovery_cache(path, kettle_client):
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as cache_file:
+            json.dump({"imei": kettle_client.imei, "kettleIP": kettle_client.host}, cache_file)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        print("[DISCOVERY] Could not save cache", path, "|", err)
+
+def main_loop(
+    host_port, imei, mqtt_broker, lvl_calib=None, auto_calib=True, data_dir=".", debug_level=1,
+    control_path=None, config_path=None, proxy_port=0, history_days=HISTORY_DAYS_DEFAULT, api_port=0,
+    subnet=None, ha_api=None, capacity_ml=KETTLE_CAPACITY_ML
+):
+    """Main event loop called from __main__
+
+    ha_api is (url, token) to also push the status straight to Home Assistant's API
+    """
+    startup_mark("import")
+    # calibration defaults
+    if not lvl_calib:
+        lvl_calib = list(LVL_CALIB_DEFAULT)
+    else:
+        lvl_calib = [int(lvl_calib[0]), int(lvl_calib[1])]
+    print("Calibration:", lvl_calib, "| auto-calibration:", "on" if auto_calib else "off")
+    calib = LevelCalibration(
+        lvl_calib[0], lvl_calib[1], auto=auto_calib, path=os.path.join(data_dir, CALIBRATION_FILE),
+        capacity_ml=capacity_ml
+    )
+
+    usage = KettleUsage(os.path.join(data_dir, USAGE_FILE))
+    kettle_client = KettleClient(
+        host_port[0], host_port[1], imei or "", calib, SEND_ENCRYPTED, usage=usage, subnet=subnet
+    )
+    apply_debug_level(kettle_client, debug_level)
+
+    # Discovery rules:
+    # - If a previous discovery matching the host (if any) is cached: use it, probe again only
+    #   if the kettle can't be reached
+    # - If host provided but imei missing: unicast probe that host to fetch IMEI/info
+    # - If neither provided: sweep the subnet if one is given, broadcast discovery otherwise
+    cache_path = os.path.join(data_dir, DISCOVERY_CACHE_FILE)
+    cached = None if imei else load_discovery_cache(cache_path)
+    rediscover = None
+    if cached and host_port[0] in (None, cached["kettleIP"]):
+        print("[DISCOVERY] Using cached kettle details:", cached)
+        kettle_client.host = cached["kettleIP"]
+        kettle_client.imei = cached["imei"]
+
+        async def rediscover():
+            print("[DISCOVERY] Cached kettle details may be stale, probing again…")
+            kettle_client.host = host_port[0]
+            if await kettle_client.discover():
+                save_discovery_cache(cache_path, kettle_client)
+            else:
+                kettle_client.host = cached["kettleIP"]
+    elif host_port[0] and not imei:
+        print("[DISCOVERY] Known host provided, discovering IMEI via unicast…")
+        if not asyncio.run(kettle_client.discover()):
+            print("Discovery (unicast) failed. Exiting.")
+            sys.exit(1)
+        save_discovery_cache(cache_path, kettle_client)
+    elif not host_port[0]:
+        mode = "subnet sweep" if subnet else "broadcast"
+        print(f"[DISCOVERY] No host provided, attempting {mode} discovery…")
+        if not asyncio.run(kettle_client.discover()):
+            print(f"Discovery ({mode}) failed and no host provided. Exiting.")
+            sys.exit(1)
+        save_discovery_cache(cache_path, kettle_client)
+    else:
+        print("[DISCOVERY] Host and IMEI provided; skipping discovery.")
+    startup_mark("discovery")
+
+    if mqtt_broker is not None and mqtt_broker[0]:
+        mqtt_broker = (
+            mqtt_broker[0], int(mqtt_broker[1]), mqtt_broker[2] or None, mqtt_broker[3] or None
+        )
+    else:
+        mqtt_broker = None  # e.g. only pushing to Home Assistant's API
+    mqtt_bridge = MqttBridge(kettle_client, mqtt_broker)
+    mqtt_bridge.connect()
+    if mqtt_broker is not None:
+        startup_mark("mqtt connect")
+
+    if kettle_client.host is None:
         print("Run again with all parameters - exiting")
         sys.exit(0)
         return
 
-    while True:
-        if not kettle_socket.connected:
-            kettle_socket.connect(host_port)
-            if kettle_socket.connected:
-                print("Connected successfully to socket on host", host_port[0])
-            else:
-                print("Could not connect to socket on host", host_port[0])
-                continue
-
-        inout = [kettle_socket.sock]
-        infds, outfds, errfds = select.select(inout, inout, [], 120)
-
-        if len(infds) != 0:
-            current_power = kettle.stat.get("power")
-            current_cmd = kettle.stat.get("cmd")
-
-            k_msg = kettle_socket.receive()
-            kettle.update_status(k_msg)
-
-            if current_power != kettle.stat.get("power") and current_cmd != kettle.stat.get("power"):
-                print("power changed: ", kettle.stat.get("power"))
-                if mqttc is not None:
-                    mqttc.publish(MQTT_COMMAND_TOPIC + "/power", kettle.stat.get("power"))
-
-            if mqttc is not None:
-                mqttc.publish(MQTT_STATUS_TOPIC + "/STATE", kettle.status_json())
-                for i in [
-                    "temperature",
-                    "target_temp",
-                    "set_target_temp",
-                    "status",
-                    "power",
-                    "version",
-                    "keep_warm_secs",
-                    "keep_warm_onoff",
-                    "volume",
-                ]:
-                    if i in kettle.stat:
-                        mqttc.publish(MQTT_STATUS_TOPIC + "/" + i, kettle.stat[i])
-
-        if time.time() - timestamp > MSG_KEEP_CONNECT_FREQ_SECS:
-            kettle_socket.keep_connect()
-            timestamp = time.time()
-
-        time.sleep(0.2)
+    backends = [mqtt_bridge]
+    if ha_api is not None:
+        backends.append(HomeAssistantBackend(*ha_api))
+    daemon = KettleDaemon(kettle_client, backends, config_path)
+    daemon.rediscover = rediscover
+    if history_days:
+        daemon.history = KettleHistory(int(history_days * 24 * 3600))
+    asyncio.run(daemon.run(control_path, proxy_port, api_port))
+
+def ack_reply(acked):
+    return "ok" if acked else "refused"
+
+def send_control_command(control_path, command):
+    """--ctl: sends one command to a running daemon and prints the reply"""
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(control_path)
+        sock.sendall(command.encode("utf-8") + b"\nq\n")
+        reply = b""
+        while chunk := sock.recv(4096):
+            reply += chunk
+    print(reply.decode("utf-8").rstrip("\n"))
+
+def load_options(config_path):
+    with open(config_path, encoding="utf-8") as config_file:
+        return json.load(config_file)
+
+def options_broker(options):
+    """MQTT broker settings from add-on options, None if no broker is configured"""
+    if not options.get("mqtt_host"):
+        return None
+    return (
+        options["mqtt_host"], int(options.get("mqtt_port", 1883)),
+        options.get("mqtt_usr") or None, options.get("mqtt_pwd") or None
+    )
+
+def apply_debug_level(kettle_client, debug_level):
+    """0: no message logging, 1: commands, 2: also heartbeats and KeepConnect"""
+    kettle_client.set_debug(debug_level >= 1, debug_level >= 2, debug_level >= 2)
+
+class KettleDaemon:
+    """Runs the kettle client with its output backends (MQTT, Home Assistant), the control socket
+    and the optional extras
+    """
+
+    def __init__(self, kettle_client, backends, config_path=None):
+        self.kettle_client = kettle_client
+        self.backends = backends
+        self.config_path = config_path
+        self.kettle_events = KettleEvents()
+        self.history = None  # KettleHistory, if enabled
+        self.api = None  # KettleApi, if enabled
+        self.tracer = LatencyTracer()
+        kettle_client.tracer = self.tracer
+        self.rediscover = None  # awaited after a failed connection to refresh stale cached details
+        self.reload_task = None
+
+    async def run(self, control_path=None, proxy_port=0, api_port=0):
+        """Runs the bridge loop with the control socket, kettle proxy, HTTP API, SIGHUP reloads
+        and a clean shutdown
+        """
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, main_task.cancel)
+        loop.add_signal_handler(signal.SIGHUP, self.cb_reload)
+
+        control_server = None
+        if control_path:
+            if os.path.exists(control_path):
+                os.unlink(control_path)
+            control_server = await asyncio.start_unix_server(self.cb_control_client, control_path)
+            print("Control socket listening on", control_path)
+
+        proxy = None
+        if proxy_port:
+            proxy = KettleProxy(self.kettle_client, port=proxy_port)
+            await proxy.start()
+
+        if api_port:
+            self.api = KettleApi(self.kettle_client, self.history, port=api_port)
+            await self.api.start()
+
+        for backend in self.backends:
+            await backend.start()
+
+        try:
+            await self.bridge_loop()
+        except asyncio.CancelledError:
+            print("Shutting down...")
+        finally:
+            if proxy is not None:
+                proxy.close()
+            if self.api is not None:
+                self.api.close()
+            if control_server is not None:
+                control_server.close()
+                os.unlink(control_path)
+            self.kettle_client.close()
+            self.kettle_client.kettle.usage.save()
+            for backend in self.backends:
+                backend.close()
+            # let the handlers of the connections closed above see EOF and return, rather than
+            # be cancelled by asyncio.run (Python 3.11 logs cancelled connection handlers)
+            await asyncio.sleep(0.1)
+
+    async def bridge_loop(self):
+        """Keeps the kettle connected and handles every status update"""
+        kettle_client = self.kettle_client
+        while True:
+            if not kettle_client.connected:
+                if await kettle_client.connect():
+                    print("Connected successfully to socket on host", kettle_client.host)
+                else:
+                    print("Could not connect to socket on host", kettle_client.host)
+                    if self.rediscover is not None:
+                        await self.rediscover()
+                    continue
+                startup_mark("kettle connect")
+
+            async for stat in kettle_client:
+                self.handle_update(stat)
+
+    def handle_update(self, stat):
+        events = self.kettle_events.update(stat)
+        for event in events:
+            print("Kettle event:", event)
+            for backend in self.backends:
+                backend.publish_event(event)
+
+        if self.history is not None and stat.get("cmd") == "STAT":
+            self.history.add(time.time(), stat)
+
+        self.tracer.observe(stat)
+        if self.api is not None:
+            self.api.publish(stat, events)
+        for backend in self.backends:
+            backend.publish_status(stat)
+        if self.tracer.published():
+            summary = self.tracer.summary()
+            for backend in self.backends:
+                backend.publish_latency(summary)
+        startup_mark("first status")
+
+    def trace(self, cmd, source="control"):
+        return self.tracer.start(cmd, source)
+
+    def cb_reload(self):
+        if self.reload_task is not None and not self.reload_task.done():
+            print("[RELOAD] Already reloading, try again once it is done")
+            return
+        self.reload_task = asyncio.ensure_future(self.reload_config())
+        self.reload_task.add_done_callback(self._log_reload_failure)
+
+    @staticmethod
+    def _log_reload_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            print("[RELOAD] Reload failed:", repr(task.exception()))
+
+    async def reload_config(self):
+        """Applies changed options without touching the kettle session (SIGHUP or "reload")"""
+        config_path = self.config_path
+        if not config_path:
+            print("[RELOAD] No --config file given, nothing to reload")
+            return
+        try:
+            options = load_options(config_path)
+        except (OSError, ValueError) as err:
+            print("[RELOAD] Could not read", config_path, "|", err)
+            return
+        print("[RELOAD] Reloading options from", config_path)
+
+        calib = self.kettle_client.kettle.calib
+        try:
+            calib.set_bounds(int(options.get("min_lvl", calib.lvl_min)), int(options.get("max_lvl", calib.lvl_max)))
+        except ValueError as err:
+            print("[RELOAD] Calibration not changed:", err)
+        calib.auto = bool(options.get("auto_calibrate", calib.auto))
+        calib.capacity_ml = int(options.get("capacity_ml", calib.capacity_ml))
+        print("[RELOAD] Calibration:", [calib.lvl_min, calib.lvl_max], "| in use:", list(calib.bounds()))
+
+        if "debug_level" in options:
+            apply_debug_level(self.kettle_client, int(options["debug_level"]))
+            print("[RELOAD] Debug level:", options["debug_level"])
+
+        for backend in self.backends:
+            await backend.reload(options)
+
+    async def cb_control_client(self, reader, writer):
+        """Serves one control socket connection: one command per line, one reply line each"""
+        try:
+            while True:
+                line = await reader.readline()
+                user_input = line.decode("utf-8", errors="replace").strip()
+                if not line or user_input == "q":
+                    break
+                if user_input == "":
+                    continue
+                reply = await self.control_command(user_input)
+                writer.write(reply.encode("utf-8") + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def control_command(self, user_input):
+        """Runs one operator command, returns the reply text"""
+        kettle_client = self.kettle_client
+        kettle = kettle_client.kettle
+        params = user_input.split()
+        try:
+            if user_input[:2] == "on":
+                if len(params) == 1:
+                    return ack_reply(await kettle_client.turn_on(trace=self.trace("on")))
+                elif len(params) == 2:
+                    temp = int(params[1])
+                    return ack_reply(await kettle_client.turn_on(temp, trace=self.trace("on")))
+            elif user_input == "off":
+                return ack_reply(await kettle_client.turn_off(trace=self.trace("off")))
+            elif user_input == "wake":
+                return ack_reply(await kettle_client.wake(trace=self.trace("wake")))
+            elif user_input == "s":
+                return kettle.status_json()
+            elif user_input == "ss":
+                return json.dumps(kettle.stat, default=str)
+            elif user_input == "lat":
+                return json.dumps(self.tracer.summary())
+            elif user_input == "fs":
+                return json.dumps(kettle_client.kettle_socket.frame_stats)
+            elif user_input == "k":
+                kettle_client.keep_connect()
+                return "sent"
+            elif user_input[:3] == "sl:":
+                kettle_client.send(bytes(user_input[3:].encode()))
+                return "sent"
+            elif user_input[:3] == "sm:":
+                kettle_client.send_enc(user_input[3:], kettle.encrypt)
+                return "sent"
+            elif user_input == "reload":
+                self.cb_reload()
+                return "reloading"
+            elif params[0] in ("hist", "histexport"):
+                return await self.history_command(params)
+        except (asyncio.TimeoutError, ConnectionError, ValueError, IndexError) as err:
+            return "error: " + repr(err)
+        return "Input not recognised: " + user_input
+
+    async def history_command(self, params):
+        """hist [secs [step]]: recent samples as JSON (HISTORY_MAX_ROWS rows at most)
+        histexport <path> [secs]: saves samples to a .csv or .npy file, in another thread so the
+        kettle link isn't held up
+        """
+        if self.history is None:
+            return "history is disabled"
+        if params[0] == "hist":
+            secs = int(params[1]) if len(params) > 1 else 3600
+            step = int(params[2]) if len(params) > 2 else None
+            rows = self.history.query(start=time.time() - secs, step=step)
+            return json.dumps({"columns": [name for name, _ in HISTORY_COLUMNS], "rows": rows})
+
+        path = params[1]
+        start = time.time() - int(params[2]) if len(params) > 2 else None
+        snapshot = self.history.snapshot(start)
+        export = snapshot.export_npy if path.endswith(".npy") else snapshot.export_csv
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, export, path)
+        except ImportError:
+            return "error: .npy export needs numpy"
+        except OSError as err:
+            return "error: " + str(err)
+        return "saved %s (%d samples)" % (path, len(snapshot))
 
 def argparser():
     parser = argparse.ArgumentParser()
@@ -713,8 +966,105 @@ def argparser():
         nargs=2,
         metavar=("lvl_min", "lvl_max"),
     )
+    parser.add_argument(
+        "--auto-calibrate",
+        help="learn the min and max volume values while the kettle sits on its base (default on)",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument(
+        "--capacity-ml",
+        help="water in the kettle at its max mark, for the water amount in mL (default 1700)",
+        default=KETTLE_CAPACITY_ML,
+        type=int,
+    )
+    parser.add_argument(
+        "--data-dir",
+        help="directory used to persist learned values (default: current directory)",
+        default=".",
+    )
+    parser.add_argument(
+        "--debug-level",
+        help="0: quiet, 1: log commands, 2: also log heartbeats and KeepConnect (default 1)",
+        default=DEBUG_LEVEL,
+        type=int,
+        choices=(0, 1, 2),
+    )
+    parser.add_argument(
+        "--control-socket",
+        help="path of the control socket (default: appkettle.sock in the data directory)",
+    )
+    parser.add_argument(
+        "--config",
+        help="add-on options JSON file, re-read on SIGHUP (e.g. /data/options.json)",
+    )
+    parser.add_argument(
+        "--proxy-port",
+        help="share the kettle session with other apps connecting to this port (default off)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--history-days",
+        help="days of heartbeats kept in memory for the hist commands, 0 to disable (default 7)",
+        default=HISTORY_DAYS_DEFAULT,
+        type=float,
+    )
+    parser.add_argument(
+        "--api-port",
+        help="serve the local HTTP API (REST and Server-Sent Events) on this port (default off)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--subnet",
+        help="find the kettle by probing every address of this subnet (e.g. 192.168.0.0/24) "
+        "instead of broadcasting",
+    )
+    parser.add_argument(
+        "--ha-url",
+        help="also push the status straight to Home Assistant's API at this URL "
+        "(e.g. http://supervisor/core in an add-on, or http://homeassistant.local:8123)",
+    )
+    parser.add_argument(
+        "--ha-token",
+        help="Home Assistant long-lived access token (default: $SUPERVISOR_TOKEN)",
+    )
+    parser.add_argument(
+        "--scan",
+        help="probe every address of this subnet, print the kettles found (JSON) and exit",
+        metavar="CIDR",
+    )
+    parser.add_argument(
+        "--ctl",
+        help="send a command (e.g. \"on 80\", \"s\", \"reload\") to the running daemon and exit",
+        metavar="COMMAND",
+    )
     args = parser.parse_args()
-    main_loop((args.host, args.port), args.imei, args.mqtt, args.calibrate)
+    if args.calibrate:
+        try:
+            if int(args.calibrate[1]) <= int(args.calibrate[0]):
+                parser.error("--calibrate: lvl_max must be above lvl_min")
+        except ValueError as err:
+            parser.error("--calibrate: " + str(err))
+    for cidr in (args.subnet, args.scan):
+        if cidr:
+            try:
+                ipaddress.ip_network(cidr, strict=False)
+            except ValueError as err:
+                parser.error(str(err))
+    if args.scan:
+        print(json.dumps(KettleSocket().kettle_probe_subnet(args.scan)))
+        return
+    control_path = args.control_socket or os.path.join(args.data_dir, CONTROL_SOCKET_FILE)
+    if args.ctl:
+        send_control_command(control_path, args.ctl)
+        return
+    main_loop(
+        (args.host, args.port), args.imei, args.mqtt, args.calibrate, args.auto_calibrate, args.data_dir,
+        args.debug_level, control_path, args.config, args.proxy_port, args.history_days, args.api_port,
+        args.subnet, (args.ha_url, args.ha_token) if args.ha_url else None, args.capacity_ml
+    )
 
 if __name__ == "__main__":
     argparser()
@@ -0,0 +1,246 @@
+#! /usr/bin/python3
+"""Local HTTP API for the kettle, served on the daemon's event loop
+
+    GET  /state                   current kettle status (JSON)
+    GET  /history?secs=&step=     heartbeat history, as the "hist" control command
+    GET  /events                  Server-Sent Events: the full status first, then only the
+                                  changed keys after each update; kettle events (see EVENTS)
+                                  are sent as "event: kettle"
+    POST /power                   body "ON", "OFF" or {"power": "ON", "temp": 80}, replies
+                                  {"acked": true/false} once the kettle answers
+    POST /target_temp             body "80" or {"target_temp": 80}
+
+There is no authentication: only enable it on a trusted network.
+"""
+
+import json
+import time
+import asyncio
+from urllib.parse import urlsplit, parse_qs
+
+from kettle_history import HISTORY_COLUMNS
+
+API_REQUEST_LIMIT = 16 * 1024
+API_SSE_PING_SECS = 15
+API_SSE_BUFFER_LIMIT = 64 * 1024
+TARGET_TEMP_RANGE = (30, 100)
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or HTTP_REASONS[status])
+        self.status = status
+
+
+class KettleApi:
+    """Minimal HTTP/1.1 server (keep-alive, no chunked bodies) for the REST and SSE endpoints"""
+
+    def __init__(self, kettle_client, history=None, host="", port=0):
+        self.kettle_client = kettle_client
+        self.history = history
+        self.host = host
+        self.port = port
+        self.server = None
+        self.clients = set()
+        self.streams = set()  # writers of the open /events streams
+        self.last_stat = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self._cb_client, self.host or None, self.port, limit=API_REQUEST_LIMIT
+        )
+        print("[API] Listening on port", self.server.sockets[0].getsockname()[1])
+
+    def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        self.clients.clear()
+        self.streams.clear()
+        self.server = None
+
+    def publish(self, stat, events=()):
+        """Sends the keys that changed since the last update, and any events, to the streams"""
+        diff = {k: v for k, v in stat.items() if k not in self.last_stat or self.last_stat[k] != v}
+        self.last_stat = dict(stat)
+        if not self.streams:
+            return
+        frame = b""
+        for event in events:
+            frame += b"event: kettle\ndata: " + event.encode() + b"\n\n"
+        if diff:
+            frame += b"data: " + json.dumps(diff, default=str).encode() + b"\n\n"
+        if frame:
+            for writer in list(self.streams):
+                self._write(writer, frame)
+
+    def _write(self, writer, frame):
+        if writer.transport.get_write_buffer_size() > API_SSE_BUFFER_LIMIT:
+            print("[API] Event stream client not keeping up, disconnecting")
+            self.streams.discard(writer)
+            writer.close()
+            return
+        writer.write(frame)
+
+    async def _cb_client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                method, target, headers = self.parse_head(head)
+                length = int(headers.get("content-length", 0))
+                if length > API_REQUEST_LIMIT:
+                    self.respond(writer, 413, {"error": HTTP_REASONS[413]}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                url = urlsplit(target)
+                if method == "GET" and url.path == "/events":
+                    await self._stream_events(reader, writer)
+                    break
+                try:
+                    status, reply = 200, await self.handle(method, url, body)
+                except HttpError as err:
+                    status, reply = err.status, {"error": str(err)}
+                except Exception as err:  # a bug in a handler shouldn't leave the client hanging
+                    print("[API]", method, url.path, "failed:", repr(err))
+                    status, reply = 500, {"error": HTTP_REASONS[500]}
+                close = headers.get("connection", "").lower() == "close"
+                self.respond(writer, status, reply, close)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    @staticmethod
+    def parse_head(head):
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    @staticmethod
+    def respond(writer, status, reply, close=False):
+        body = json.dumps(reply, default=str).encode()
+        writer.write(
+            b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n"
+            % (status, HTTP_REASONS[status].encode(), len(body), b"Connection: close\r\n" if close else b"")
+            + body
+        )
+
+    async def _stream_events(self, reader, writer):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        writer.write(b"data: " + json.dumps(self.kettle_client.kettle.stat, default=str).encode() + b"\n\n")
+        self.streams.add(writer)
+        try:
+            while True:
+                try:
+                    # nothing is expected from the client, this only notices it going away
+                    if not await asyncio.wait_for(reader.read(1024), API_SSE_PING_SECS):
+                        return
+                except asyncio.TimeoutError:
+                    if writer not in self.streams:
+                        return
+                    writer.write(b": ping\n\n")
+        finally:
+            self.streams.discard(writer)
+
+    async def handle(self, method, url, body):
+        """Runs one REST request, returns the reply object or raises HttpError"""
+        routes = {
+            "/state": ("GET", self.get_state),
+            "/history": ("GET", self.get_history),
+            "/power": ("POST", self.post_power),
+            "/target_temp": ("POST", self.post_target_temp),
+        }
+        if url.path not in routes:
+            raise HttpError(404)
+        route_method, handler = routes[url.path]
+        if method != route_method:
+            raise HttpError(405)
+        return await handler(parse_qs(url.query), body)
+
+    async def get_state(self, query, body):
+        return self.kettle_client.kettle.stat
+
+    async def get_history(self, query, body):
+        if self.history is None:
+            raise HttpError(404, "history is disabled")
+        try:
+            secs = int(query.get("secs", ["3600"])[0])
+            step = int(query["step"][0]) if "step" in query else None
+        except ValueError as err:
+            raise HttpError(400, str(err)) from err
+        rows = self.history.query(start=time.time() - secs, step=step)
+        return {"columns": [name for name, _ in HISTORY_COLUMNS], "rows": rows}
+
+    async def post_power(self, query, body):
+        params = self.parse_body(body, "power")
+        power = str(params.get("power", "")).upper()
+        if power not in ("ON", "OFF"):
+            raise HttpError(400, "power must be ON or OFF")
+        try:
+            temp = None if params.get("temp") is None else int(params["temp"])
+        except (TypeError, ValueError, OverflowError) as err:
+            raise HttpError(400, "temp must be a number") from err
+        if temp is not None and not TARGET_TEMP_RANGE[0] <= temp <= TARGET_TEMP_RANGE[1]:
+            raise HttpError(400, "temp must be between %d and %d" % TARGET_TEMP_RANGE)
+
+        tracer = self.kettle_client.tracer
+        trace = tracer.start(power.lower(), "api") if tracer is not None else None
+        try:
+            if power == "ON":
+                acked = await self.kettle_client.turn_on(temp, trace=trace)
+            else:
+                acked = await self.kettle_client.turn_off(trace=trace)
+        except ConnectionError as err:
+            raise HttpError(503, str(err)) from err
+        except asyncio.TimeoutError as err:
+            raise HttpError(504, "kettle did not answer") from err
+        return {"acked": bool(acked)}
+
+    async def post_target_temp(self, query, body):
+        params = self.parse_body(body, "target_temp")
+        try:
+            temp = int(params.get("target_temp"))
+        except (TypeError, ValueError, OverflowError) as err:
+            raise HttpError(400, "target_temp must be a number") from err
+        if not TARGET_TEMP_RANGE[0] <= temp <= TARGET_TEMP_RANGE[1]:
+            raise HttpError(400, "target_temp must be between %d and %d" % TARGET_TEMP_RANGE)
+        self.kettle_client.kettle.stat["set_target_temp"] = temp
+        return {"set_target_temp": temp}
+
+    @staticmethod
+    def parse_body(body, key):
+        """Accepts a JSON object or a bare value (e.g. "ON") for key"""
+        text = body.decode("utf-8", errors="replace").strip()
+        if text.startswith("{"):
+            try:
+                params = json.loads(text)
+            except ValueError as err:
+                raise HttpError(400, "invalid JSON: " + str(err)) from err
+            if not isinstance(params, dict):
+                raise HttpError(400, "expected a JSON object")
+            return params
+        return {key: text}
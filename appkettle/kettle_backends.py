@@ -0,0 +1,291 @@
+#! /usr/bin/python3
+"""Output backends: where the daemon sends kettle status, events and latency stats
+
+OutputBackend is the interface, MqttBridge (appkettle_mqtt.py) and HomeAssistantBackend
+implement it. HomeAssistantBackend writes entity states straight into Home Assistant over
+its REST API (the WebSocket API has no command to set a state), reusing one keep-alive
+connection and sending only the states that changed, batched.
+"""
+
+import os
+import json
+import asyncio
+from urllib.parse import urlsplit, quote
+
+HA_URL_SUPERVISOR = "http://supervisor/core"
+HA_BATCH_SECS = 0.25  # changes within this window go out together
+HA_RETRY_SECS = 5
+HA_TIMEOUT_SECS = 10
+HA_EVENT_TYPE = "appkettle_event"
+HA_RESPONSE_LIMIT = 64 * 1024
+HA_REFUSED_STATUSES = (401, 403)  # bad token, or banned: stop pushing until a reload
+
+# status key -> (entity_id, attributes)
+HA_ENTITIES = {
+    "temperature": ("sensor.appkettle_temperature", {
+        "friendly_name": "Kettle Current Temperature", "unit_of_measurement": "°C",
+        "device_class": "temperature", "state_class": "measurement", "icon": "mdi:water-thermometer",
+    }),
+    "target_temp": ("sensor.appkettle_target_temperature", {
+        "friendly_name": "Kettle Target Temperature", "unit_of_measurement": "°C",
+        "device_class": "temperature", "icon": "mdi:thermometer-check",
+    }),
+    "status": ("sensor.appkettle_status", {"friendly_name": "Kettle Status", "icon": "mdi:kettle-alert"}),
+    "power": ("binary_sensor.appkettle_power", {
+        "friendly_name": "Kettle Power", "device_class": "power", "icon": "mdi:kettle",
+    }),
+    "keep_warm_onoff": ("binary_sensor.appkettle_keep_warm", {
+        "friendly_name": "Kettle Keep Warm", "icon": "mdi:kettle-steam",
+    }),
+    "fill_level": ("sensor.appkettle_fill_level", {
+        "friendly_name": "Kettle Fill Level", "unit_of_measurement": "%", "icon": "mdi:cup-water",
+    }),
+    "fill_ml": ("sensor.appkettle_water_amount", {
+        "friendly_name": "Kettle Water Amount", "unit_of_measurement": "mL", "icon": "mdi:water",
+    }),
+    "volume": ("sensor.appkettle_water_volume", {"friendly_name": "Kettle Water Volume", "icon": "mdi:cup-water"}),
+    "energy_kwh": ("sensor.appkettle_energy", {
+        "friendly_name": "Kettle Energy", "unit_of_measurement": "kWh", "device_class": "energy",
+        "state_class": "total_increasing", "icon": "mdi:lightning-bolt",
+    }),
+    "last_boil_kwh": ("sensor.appkettle_last_boil_energy", {
+        "friendly_name": "Kettle Last Boil Energy", "unit_of_measurement": "kWh",
+        "state_class": "measurement", "icon": "mdi:lightning-bolt-outline",
+    }),
+    "boil_count": ("sensor.appkettle_boils", {
+        "friendly_name": "Kettle Boils", "state_class": "total_increasing", "icon": "mdi:counter",
+    }),
+    "water_boiled_l": ("sensor.appkettle_water_boiled", {
+        "friendly_name": "Kettle Water Boiled", "unit_of_measurement": "L", "device_class": "water",
+        "state_class": "total_increasing", "icon": "mdi:water-boiler",
+    }),
+    "link_rtt_ms": ("sensor.appkettle_link_rtt", {
+        "friendly_name": "Kettle Link RTT", "unit_of_measurement": "ms", "state_class": "measurement",
+        "icon": "mdi:lan-pending",
+    }),
+    "heartbeat_jitter_ms": ("sensor.appkettle_heartbeat_jitter", {
+        "friendly_name": "Kettle Heartbeat Jitter", "unit_of_measurement": "ms",
+        "state_class": "measurement", "icon": "mdi:pulse",
+    }),
+}
+HA_LATENCY_ENTITY = ("sensor.appkettle_ack_latency", {
+    "friendly_name": "Kettle Ack Latency", "unit_of_measurement": "ms", "state_class": "measurement",
+    "icon": "mdi:timer-outline",
+})
+
+
+class OutputBackend:
+    """Receives kettle updates from the daemon. connect() runs before the event loop starts,
+    everything else on the loop; none of the publish methods may block
+    """
+
+    def connect(self):
+        """Blocking setup, before the event loop starts"""
+
+    async def start(self):
+        """Setup on the event loop"""
+
+    async def reload(self, options):
+        """Applies changed add-on options (SIGHUP or "reload")"""
+
+    def close(self):
+        pass
+
+    def publish_status(self, stat):
+        pass
+
+    def publish_event(self, event):
+        pass
+
+    def publish_latency(self, summary):
+        pass
+
+
+class HomeAssistantBackend(OutputBackend):
+    """Pushes entity states and events to Home Assistant's REST API
+
+    url is the API base (HA_URL_SUPERVISOR inside an add-on, or e.g. http://homeassistant.local:8123
+    with a long-lived access token), token defaults to $SUPERVISOR_TOKEN. Once Home Assistant
+    refuses the token nothing more is sent until reload(), so a bad token doesn't get the
+    add-on's IP banned
+    """
+
+    def __init__(self, url=HA_URL_SUPERVISOR, token=None):
+        parts = urlsplit(url)
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = parts.scheme == "https"
+        self.base_path = parts.path.rstrip("/")
+        self.token_arg = token
+        self.token = token or os.environ.get("SUPERVISOR_TOKEN", "")
+        self.states = {}  # entity_id -> (state, attributes) last pushed
+        self.pending = {}  # entity_id -> (state, attributes) waiting for the next batch
+        self.events = []
+        self.wakeup = None
+        self.task = None
+        self.refused = False
+        self._reader = self._writer = None
+
+    async def start(self):
+        if not self.token:
+            print("[HA] No API token (SUPERVISOR_TOKEN), Home Assistant output disabled")
+            return
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._push_loop())
+        print("[HA] Pushing states to", self.url)
+
+    async def reload(self, options):
+        if not self.refused:
+            return
+        self.token = self.token_arg or os.environ.get("SUPERVISOR_TOKEN", "")
+        self.refused = False
+        print("[HA] Resuming Home Assistant output")
+        self._push_all()
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self._disconnect()
+
+    def publish_status(self, stat):
+        for key, (entity_id, attributes) in HA_ENTITIES.items():
+            if stat.get(key) is not None:
+                value = stat[key]
+                if entity_id.startswith("binary_sensor."):
+                    value = "on" if value in (True, "ON") else "off"
+                self._set(entity_id, str(value), attributes)
+
+    def publish_event(self, event):
+        if self.wakeup is not None and not self.refused:
+            self.events.append(event)
+            self.wakeup.set()
+
+    def publish_latency(self, summary):
+        entity_id, attributes = HA_LATENCY_ENTITY
+        acked = summary.get("acked", {})
+        if acked.get("last") is not None:
+            self._set(entity_id, str(acked["last"]), dict(attributes, **{
+                stage: {k: v for k, v in stats.items() if k != "buckets"} for stage, stats in summary.items()
+            }))
+
+    def _set(self, entity_id, state, attributes):
+        if self.wakeup is None:
+            return
+        if self.states.get(entity_id) == (state, attributes):
+            self.pending.pop(entity_id, None)
+            return
+        self.pending[entity_id] = (state, attributes)
+        if not self.refused:
+            self.wakeup.set()
+
+    def _push_all(self):
+        """Sends every state again with the next batch, e.g. after Home Assistant restarted"""
+        self.pending = dict(self.states, **self.pending)
+        self.states.clear()
+        self.wakeup.set()
+
+    async def _push_loop(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(HA_BATCH_SECS)
+            self.wakeup.clear()
+            batch, self.pending = list(self.pending.items()), {}
+            events, self.events = self.events, []
+            requests = [
+                (self.base_path + "/api/states/" + entity_id, {"state": state, "attributes": attributes})
+                for entity_id, (state, attributes) in batch
+            ] + [
+                (self.base_path + "/api/events/" + HA_EVENT_TYPE, {"type": event}) for event in events
+            ]
+            statuses = []
+            try:
+                await asyncio.wait_for(self._post_all(requests, statuses), HA_TIMEOUT_SECS)
+                failed = None
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as err:
+                failed = repr(err)
+                self._disconnect()
+
+            unsent = []
+            for (entity_id, state), status in zip(batch, statuses):
+                if status >= 500 or status in HA_REFUSED_STATUSES:
+                    unsent.append((entity_id, state))
+                    if status >= 500 and failed is None:
+                        failed = "HTTP %d" % status
+                else:
+                    # other 4xx would fail the same way again, so they count as sent
+                    self.states[entity_id] = state
+            answered = len(statuses)
+            # put back whatever wasn't taken, unless a newer state came in meanwhile
+            self.pending = dict(unsent + batch[answered:], **self.pending)
+            self.events = events[max(0, answered - len(batch)):] + self.events
+            if self.refused:
+                self.events.clear()
+                self.wakeup.clear()
+                self._disconnect()
+            elif failed is not None:
+                print("[HA] Push failed, retrying in %ds:" % HA_RETRY_SECS, failed)
+                # push every state again once reconnected, in case Home Assistant restarted
+                await asyncio.sleep(HA_RETRY_SECS)
+                self._push_all()
+            elif answered < len(requests):
+                self.wakeup.set()
+
+    async def _post_all(self, requests, statuses):
+        """Sends the requests back to back on the keep-alive connection, then reads the replies,
+        appending each HTTP status to statuses
+        """
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl or None, limit=HA_RESPONSE_LIMIT
+            )
+        for path, body in requests:
+            payload = json.dumps(body).encode()
+            self._writer.write(
+                b"POST %s HTTP/1.1\r\nHost: %s\r\nAuthorization: Bearer %s\r\n"
+                b"Content-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+                % (quote(path).encode(), self.host.encode(), self.token.encode(), len(payload))
+                + payload
+            )
+        await self._writer.drain()
+        for path, _ in requests:
+            status, close = await self._read_response()
+            statuses.append(status)
+            if status in HA_REFUSED_STATUSES:
+                if not self.refused:
+                    print(
+                        "[HA] Home Assistant refused the API token (HTTP %d), pausing until the"
+                        " options are reloaded; check the token or homeassistant_api" % status
+                    )
+                self.refused = True
+            elif status >= 300:
+                print("[HA] POST", path, "failed with HTTP", status)
+            if close:
+                self._disconnect()
+                return
+
+    async def _read_response(self):
+        """Reads one response, returns (status, whether the server closes the connection)"""
+        head = await self._reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split(" ", 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip().lower()
+        if headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await self._reader.readexactly(int(headers.get("content-length", 0)))
+        return status, headers.get("connection") == "close"
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
@@ -0,0 +1,1321 @@
+#! /usr/bin/python3
+"""Library for talking to an appKettle over the local network
+
+Provides the kettle model (AppKettle), the socket, discovery and encryption helpers
+(KettleSocket) and an asyncio client (KettleClient) that can be embedded in other
+programs. appkettle_mqtt.py is one consumer of it.
+
+    async def main():
+        client = KettleClient("192.168.0.20", imei="GD0-12300-35aa")
+        await client.connect()
+        await client.turn_on(80)
+        async for stat in client:
+            print(stat["status"], stat["temperature"])
+"""
+
+import sys
+import re
+import time
+import socket
+import asyncio
+import os
+import json
+import selectors
+import ipaddress
+import traceback
+from collections import deque
+
+from protocol_parser import (
+    unpack_msg, cmd_unpack, calc_msg_checksum, set_msg_seq, ACK_OK, STATES_MAP
+)
+
+DEBUG_MSG = False
+DEBUG_PRINT_STAT_MSG = False
+DEBUG_PRINT_KEEP_CONNECT = False
+SEND_ENCRYPTED = False
+MSGLEN = 3200
+
+KETTLE_PORT = 6002
+KETTLE_SOCKET_CONNECT_ATTEMPTS = 3
+KETTLE_SOCKET_TIMEOUT_SECS = 60
+KETTLE_ACK_TIMEOUT_SECS = 5
+KETTLE_UPDATES_QUEUE_LEN = 64
+KEEP_WARM_MINS = 10
+PROXY_CLIENT_BUFFER_LIMIT = 64 * 1024
+
+# Fill level calibration. Learned min/max volume readings only replace the configured ones
+# once they span LVL_CALIB_MIN_SPAN, and a reading is only trusted after it has been stable
+# (within LVL_CALIB_TOLERANCE) for LVL_CALIB_STABLE_SAMPLES heartbeats in "Ready". Readings
+# further than LVL_CALIB_BAND x the configured span outside the configured min/max (e.g.
+# something leaning on the kettle) are never learned
+LVL_CALIB_DEFAULT = (160, 1640)
+LVL_CALIB_MIN_SPAN = 1000
+LVL_CALIB_TOLERANCE = 5
+LVL_CALIB_STABLE_SAMPLES = 60
+LVL_CALIB_BAND = 0.25
+KETTLE_CAPACITY_ML = 1700  # water at the max mark, i.e. at a 100% fill level
+CALIBRATION_FILE = "appkettle_calibration.json"
+
+# Energy and water accounting, see KettleUsage. Heating energy is the heat taken up by the
+# water (temperature rise x water mass) over HEATING_EFFICIENCY, keep warm energy is time
+# in "Keep Warm" at KEEP_WARM_WATTS. Gaps over USAGE_MAX_GAP_SECS between heartbeats
+# (e.g. reconnects) are not counted
+WATER_HEAT_CAPACITY = 4186  # J/(kg*K)
+HEATING_EFFICIENCY = 0.85
+KEEP_WARM_WATTS = 100
+USAGE_MAX_GAP_SECS = 10
+USAGE_FILE = "appkettle_usage.json"
+
+# Kettle events, see KettleEvents. Heating counts as having reached the target if it stops
+# within TARGET_TEMP_TOLERANCE degrees of it, and keep warm as expired if it ends with at most
+# KEEP_WARM_EXPIRY_SECS left on the countdown
+EVENT_LIFTED = "lifted"
+EVENT_PLACED = "placed"
+EVENT_HEATING_STARTED = "heating_started"
+EVENT_TARGET_REACHED = "target_reached"
+EVENT_KEEP_WARM_STARTED = "keep_warm_started"
+EVENT_KEEP_WARM_EXPIRED = "keep_warm_expired"
+EVENTS = (
+    EVENT_LIFTED, EVENT_PLACED, EVENT_HEATING_STARTED, EVENT_TARGET_REACHED,
+    EVENT_KEEP_WARM_STARTED, EVENT_KEEP_WARM_EXPIRED,
+)
+TARGET_TEMP_TOLERANCE = 2
+KEEP_WARM_EXPIRY_SECS = 2
+
+ENCRYPT_HEADER = bytes([0x23, 0x23, 0x38, 0x30])
+PLAIN_HEADER   = bytes([0x23, 0x23, 0x30, 0x30])
+FRAME_END = b"&&"
+MSG_KEEP_CONNECT = b"##000bKeepConnect&&"
+KEEP_CONNECT = b"KeepConnect"
+# Link supervision, see LinkMonitor: the kettle sends a heartbeat about every second, so
+# after LINK_PROBE_SECS of silence a KeepConnect is sent as a probe and after LINK_DEAD_SECS
+# the session is dropped. While heartbeats flow a KeepConnect is only sent every
+# LINK_KEEP_CONNECT_MAX_SECS, to keep the RTT measurement current
+LINK_CHECK_SECS = 1
+LINK_PROBE_SECS = 3
+LINK_DEAD_SECS = 6
+LINK_KEEP_CONNECT_MAX_SECS = 300
+UDP_IP_BCAST_DEFAULT = "255.255.255.255"
+UDP_PORT = 15103
+DISCOVERY_STAT_KEYS = ("imei", "version", "kettleIP")  # probe reply keys kept in the kettle status
+# Subnet sweep, see KettleSocket.kettle_probe_subnet: probes are paced at SWEEP_PROBES_PER_SEC
+# and replies are awaited for SWEEP_REPLY_WAIT_SECS after the last one
+SWEEP_PROBES_PER_SEC = 500
+SWEEP_REPLY_WAIT_SECS = 1.5
+SWEEP_MAX_HOSTS = 4096
+
+# Nearly every frame from the kettle is a flat {"wifi_cmd":"..",..,"data3":"<hex>"} object, so
+# data3 is pulled out with a regex and json.loads is only the fallback for anything else
+FAST_FRAME_RE = re.compile(rb'\{"wifi_cmd": ?"(\w*)",[^{}]*?"data3": ?"([0-9A-Fa-f]*)"\}')
+
+# AES secrets:
+SECRET_KEY = b"ay3$&dw*ndAD!9)<"
+SECRET_IV  = b"7e3*WwI(@Dczxcue"
+AES_BLOCK_SIZE = 16
+
+class LevelCalibration:
+    """Converts raw volume readings into a fill level, learning the empty and full points"""
+
+    def __init__(
+        self, lvl_min=LVL_CALIB_DEFAULT[0], lvl_max=LVL_CALIB_DEFAULT[1], auto=True, path=None,
+        capacity_ml=KETTLE_CAPACITY_ML
+    ):
+        self.set_bounds(lvl_min, lvl_max)
+        self.auto = auto
+        self.capacity_ml = capacity_ml
+        self.path = path
+        self.seen_min = None
+        self.seen_max = None
+        self._last = None
+        self._stable = 0
+        self.load()
+
+    def set_bounds(self, lvl_min, lvl_max):
+        """Sets the configured empty and full readings, raises ValueError unless lvl_min < lvl_max"""
+        if lvl_max <= lvl_min:
+            raise ValueError("max level (%d) must be above min level (%d)" % (lvl_max, lvl_min))
+        self.lvl_min = lvl_min
+        self.lvl_max = lvl_max
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as calib_file:
+                learned = json.load(calib_file)
+            self.seen_min = int(learned["seen_min"])
+            self.seen_max = int(learned["seen_max"])
+            print("Loaded learned calibration:", [self.seen_min, self.seen_max])
+            if not (self.plausible(self.seen_min) and self.plausible(self.seen_max)):
+                print("Learned calibration is too far from", [self.lvl_min, self.lvl_max], "| learning again")
+                self.seen_min = self.seen_max = None
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            print("Could not load calibration file", self.path, "|", err)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as calib_file:
+                json.dump({"seen_min": self.seen_min, "seen_max": self.seen_max}, calib_file)
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            print("Could not save calibration file", self.path, "|", err)
+
+    def plausible(self, volume):
+        """True if volume is within LVL_CALIB_BAND of the configured min and max"""
+        band = (self.lvl_max - self.lvl_min) * LVL_CALIB_BAND
+        return self.lvl_min - band <= volume <= self.lvl_max + band
+
+    def bounds(self):
+        """Returns the (min, max) volume readings currently used for the fill level"""
+        if (
+            self.auto
+            and self.seen_min is not None
+            and self.seen_max - self.seen_min >= LVL_CALIB_MIN_SPAN
+            and self.plausible(self.seen_min)
+            and self.plausible(self.seen_max)
+        ):
+            return self.seen_min, self.seen_max
+        return self.lvl_min, self.lvl_max
+
+    def observe(self, status, volume):
+        """Feeds a heartbeat reading, returns True if the learned range changed"""
+        if not self.auto or status != "Ready" or volume <= 0 or not self.plausible(volume):
+            self._last = None
+            self._stable = 0
+            return False
+
+        if self._last is not None and abs(volume - self._last) <= LVL_CALIB_TOLERANCE:
+            self._stable += 1
+        else:
+            self._stable = 1
+        self._last = volume
+        if self._stable < LVL_CALIB_STABLE_SAMPLES:
+            return False
+
+        changed = False
+        if self.seen_min is None or volume < self.seen_min:
+            self.seen_min = volume
+            changed = True
+        if self.seen_max is None or volume > self.seen_max:
+            self.seen_max = volume
+            changed = True
+        if changed:
+            print("Learned calibration:", [self.seen_min, self.seen_max], "| in use:", list(self.bounds()))
+            self.save()
+        return changed
+
+    def fill_fraction(self, volume):
+        """How full the kettle is, 0.0 (empty) to 1.0 (max mark)"""
+        lvl_min, lvl_max = self.bounds()
+        return min(1.0, max(0.0, (volume - lvl_min) / (lvl_max - lvl_min)))
+
+    def fill_level(self, volume):
+        """Fill level in % (0-100)"""
+        return round(self.fill_fraction(volume) * 100)
+
+    def fill_ml(self, volume):
+        """Water in the kettle in ml. The raw reading's scale isn't known (and the learned span
+        varies between kettles), so this is the fill fraction of capacity_ml
+        """
+        return round(self.fill_fraction(volume) * self.capacity_ml)
+
+
+class KettleUsage:
+    """Running totals of estimated energy use, boils and water boiled, updated per heartbeat"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.energy_kwh = 0.0
+        self.boil_count = 0
+        self.water_boiled_l = 0.0
+        self.last_boil_kwh = 0.0
+        self._status = None
+        self._temperature = None
+        self._ts = None
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as usage_file:
+                totals = json.load(usage_file)
+            self.energy_kwh = float(totals["energy_kwh"])
+            self.boil_count = int(totals["boil_count"])
+            self.water_boiled_l = float(totals["water_boiled_l"])
+            self.last_boil_kwh = float(totals.get("last_boil_kwh", 0))
+            print("Loaded usage totals:", self.totals())
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            print("Could not load usage file", self.path, "|", err)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as usage_file:
+                json.dump(self.totals(), usage_file)
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            print("Could not save usage file", self.path, "|", err)
+
+    def totals(self):
+        return {
+            "energy_kwh": round(self.energy_kwh, 4),
+            "boil_count": self.boil_count,
+            "water_boiled_l": round(self.water_boiled_l, 3),
+            "last_boil_kwh": round(self.last_boil_kwh, 4),
+        }
+
+    def observe(self, status, temperature, fill_ml, now=None):
+        """Feeds a heartbeat reading, saves the totals when a boil or keep warm ends"""
+        now = time.monotonic() if now is None else now
+        prev_status, prev_temperature, prev_ts = self._status, self._temperature, self._ts
+        self._status, self._temperature, self._ts = status, temperature, now
+        if prev_status is None:
+            return
+
+        if status == "Heating" and prev_status != "Heating":
+            self.boil_count += 1
+            self.water_boiled_l += fill_ml / 1000
+            self.last_boil_kwh = 0.0
+
+        joules = 0.0
+        if status == "Heating" and temperature > prev_temperature:
+            joules = (
+                (temperature - prev_temperature) * fill_ml / 1000 * WATER_HEAT_CAPACITY
+                / HEATING_EFFICIENCY
+            )
+        elif status == "Keep Warm" and prev_status == "Keep Warm":
+            gap = now - prev_ts
+            if gap <= USAGE_MAX_GAP_SECS:
+                joules = gap * KEEP_WARM_WATTS
+        if joules:
+            kwh = joules / 3.6e6
+            self.energy_kwh += kwh
+            if status == "Heating":
+                self.last_boil_kwh += kwh
+
+        if prev_status in ("Heating", "Keep Warm") and status not in ("Heating", "Keep Warm"):
+            self.save()
+
+
+class AppKettle:
+    """Represents a physical appKettle
+
+    sock is anything with a send_enc(data2, encrypt) method: a KettleSocket or a KettleClient
+    """
+
+    def __init__(self, sock=None, calib=None, encrypt=SEND_ENCRYPTED, usage=None):
+        self.sock = sock
+        self.calib = calib if calib is not None else LevelCalibration(auto=False)
+        self.usage = usage if usage is not None else KettleUsage()
+        self.encrypt = encrypt
+        self.debug_msg = DEBUG_MSG
+        self.debug_stat_msg = DEBUG_PRINT_STAT_MSG
+        self.debug_keep_connect = DEBUG_PRINT_KEEP_CONNECT
+        self.stat = {
+            "cmd": "unk",
+            "status": "unk",
+            "keep_warm_secs": 0,
+            "keep_warm_onoff": False,
+            "temperature": 0,
+            "target_temp": 0,
+            "set_target_temp": 100,
+            "volume": 0,
+            "fill_level": 0,
+            "fill_ml": 0,
+            "energy_kwh": self.usage.energy_kwh,
+            "boil_count": self.usage.boil_count,
+            "water_boiled_l": self.usage.water_boiled_l,
+            "last_boil_kwh": self.usage.last_boil_kwh,
+            "power": "OFF",
+            "seq": 0,
+        }
+
+    def tick(self):
+        self.stat["seq"] = (self.stat["seq"] + 1) % 0xFF
+
+    def turn_on(self, temp=None):
+        """Sends the ON command, returns the seq byte used"""
+        if self.stat["status"] != "Ready":
+            self.wake()
+        self.tick()
+        if temp is None:
+            temp = self.stat["set_target_temp"]
+        msg = "AA001200000000000003B7{seq}39000000{temp}{kw}0000".format(
+            temp=("%0.2X" % temp),
+            kw=("%0.2X" % (KEEP_WARM_MINS * self.stat["keep_warm_onoff"])),
+            seq=("%0.2x" % self.stat["seq"]),
+        )
+        msg = calc_msg_checksum(msg, append=True)
+        self.sock.send_enc(msg, self.encrypt)
+        return self.stat["seq"]
+
+    def wake(self):
+        """Sends the WAKE command, returns the seq byte used"""
+        self.tick()
+        msg = "AA000D00000000000003B7{seq}410000".format(seq=("%0.2x" % self.stat["seq"]))
+        msg = calc_msg_checksum(msg, append=True)
+        self.sock.send_enc(msg, self.encrypt)
+        return self.stat["seq"]
+
+    def turn_off(self):
+        """Sends the OFF command, returns the seq byte used"""
+        self.tick()
+        msg = "AA000D00000000000003B7{seq}3A0000".format(seq=("%0.2x" % self.stat["seq"]))
+        msg = calc_msg_checksum(msg, append=True)
+        self.sock.send_enc(msg, self.encrypt)
+        return self.stat["seq"]
+
+    def status_json(self):
+        keys = {
+            "power", "status", "temperature", "target_temp", "volume", "fill_level", "fill_ml",
+            "keep_warm_secs"
+        }
+        status_dict = {k: self.stat[k] for k in self.stat.keys() & keys}
+        return json.dumps(status_dict)
+
+    def update_fill(self):
+        """Recalculates the fill level from the latest volume reading"""
+        volume = self.stat["volume"]
+        self.calib.observe(self.stat["status"], volume)
+        self.stat["fill_level"] = self.calib.fill_level(volume)
+        self.stat["fill_ml"] = self.calib.fill_ml(volume)
+
+    def update_usage(self):
+        """Accounts the latest heartbeat in the energy and water totals"""
+        stat = self.stat
+        self.usage.observe(stat["status"], stat["temperature"], stat["fill_ml"])
+        stat.update(self.usage.totals())
+
+    def update_status(self, msg):
+        """Parses a wifi_cmd message to match this class status with the physical kettle
+
+        Returns the parsed command dict if the message updated the status, None otherwise
+        """
+        try:
+            cmd_dict = unpack_msg(
+                msg, self.debug_msg, self.debug_stat_msg, self.debug_keep_connect
+            )
+        except ValueError:
+            print("Error in decoding: ", msg)
+            return None
+    
+        if not isinstance(cmd_dict, dict):
+            # nothing useful
+            return None
+    
+        # If unpack_msg already gave us flattened status keys, merge them
+        # (typical keys seen: cmd, status, temperature, target_temp, volume, power, keep_warm_secs, etc.)
+        known_keys = {
+            "cmd", "status", "temperature", "target_temp", "set_target_temp",
+            "volume", "power", "keep_warm_secs", "keep_warm_onoff", "version"
+        }
+        if known_keys & cmd_dict.keys():
+            for k in known_keys:
+                if k in cmd_dict:
+                    self.stat[k] = cmd_dict[k]
+            if "volume" in cmd_dict:
+                self.update_fill()
+            if "status" in cmd_dict:
+                self.update_usage()
+            return cmd_dict
+    
+        # Legacy path: some decoders nest under data3 (keep for compatibility)
+        if "data3" in cmd_dict and isinstance(cmd_dict["data3"], dict):
+            for k in known_keys:
+                if k in cmd_dict["data3"]:
+                    self.stat[k] = cmd_dict["data3"][k]
+            if "volume" in cmd_dict["data3"]:
+                self.update_fill()
+            if "status" in cmd_dict["data3"]:
+                self.update_usage()
+            return cmd_dict["data3"]
+    
+        # Messages we sent (debug traffic) or other frames we don't care about
+        if "data2" in cmd_dict:
+            return None
+    
+        print("Unparsed Json message: ", cmd_dict)
+        return None
+  
+
+class KettleEvents:
+    """Turns the stream of kettle status snapshots into transition events (see EVENTS)"""
+
+    def __init__(self):
+        self.status = None
+        self.keep_warm_secs = 0
+        self.keep_warm_expired = False
+
+    def update(self, stat):
+        """Feeds a status snapshot, returns the list of events it caused (usually empty)"""
+        status = stat.get("status")
+        if status not in STATES_MAP:
+            return []
+        keep_warm_secs = stat.get("keep_warm_secs", 0)
+        prev_status, prev_keep_warm_secs = self.status, self.keep_warm_secs
+        self.status, self.keep_warm_secs = status, keep_warm_secs
+        if prev_status is None:
+            # first status seen: nothing to compare against
+            return []
+
+        events = []
+        if status != prev_status:
+            if status == "Not on base":
+                events.append(EVENT_LIFTED)
+            elif prev_status == "Not on base":
+                events.append(EVENT_PLACED)
+
+            if status == "Heating":
+                events.append(EVENT_HEATING_STARTED)
+            elif (
+                prev_status == "Heating"
+                and status != "Not on base"
+                and stat.get("temperature", 0) >= stat.get("target_temp", 0) - TARGET_TEMP_TOLERANCE
+            ):
+                events.append(EVENT_TARGET_REACHED)
+
+            if status == "Keep Warm":
+                events.append(EVENT_KEEP_WARM_STARTED)
+                self.keep_warm_expired = False
+
+        if prev_status == "Keep Warm" and not self.keep_warm_expired and (
+            # countdown finished, before or as the kettle leaves keep warm by itself
+            (status == "Keep Warm" and keep_warm_secs == 0 and prev_keep_warm_secs > 0)
+            or (status in ("Ready", "Standby") and prev_keep_warm_secs <= KEEP_WARM_EXPIRY_SECS)
+        ):
+            events.append(EVENT_KEEP_WARM_EXPIRED)
+            self.keep_warm_expired = True
+
+        return events
+
+
+class KettleSocket:
+    """Handles connection, encryption and decryption for an AppKettle"""
+
+    def __init__(self, sock=None, imei="", broadcast_ip=UDP_IP_BCAST_DEFAULT, subnet=None):
+        if sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.settimeout(KETTLE_SOCKET_TIMEOUT_SECS)
+        else:
+            self.sock = sock
+        self.connected = False
+        self.imei = imei
+        self.stat = ""
+        self.broadcast_ip = broadcast_ip
+        self.subnet = subnet  # CIDR swept with unicast probes instead of broadcasting
+        # how each frame received from the kettle was decoded, see decode_frame
+        self.frame_stats = {"fast_path": 0, "fallback": 0, "keep_connect": 0, "undecoded": 0}
+        self.debug_msg = DEBUG_MSG
+        self.debug_keep_connect = DEBUG_PRINT_KEEP_CONNECT
+
+    def connect(self, host_port):
+        attempts = KETTLE_SOCKET_CONNECT_ATTEMPTS
+        print("Attempting to connect to socket...")
+        while attempts and not self.connected:
+            try:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.settimeout(KETTLE_SOCKET_TIMEOUT_SECS)
+                self.sock.connect(host_port)
+                self.keep_connect()
+                self.connected = True
+                return
+            except (TimeoutError, OSError) as err:
+                print("Socket error:", err, "|", attempts, "attempts remaining")
+                attempts -= 1
+                self.connected = False
+        print("Socket timeout")
+        self.connected = False
+
+    # ---------- Discovery helpers ----------
+    def _parse_probe_reply(self, payload, address):
+        parts = payload.split("#")
+        if len(parts) < 7:
+            print("[DISCOVERY] Unexpected reply format")
+            return None
+        msg_json = json.loads(parts[6])
+        msg_json.update({"imei": parts[0], "version": parts[3], "kettleIP": address[0]})
+        return msg_json
+
+    def kettle_probe_unicast(self, ip, timeout=5):
+        """Send a unicast probe to a known IP and parse reply to get IMEI & info."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("", UDP_PORT))
+        except OSError as e:
+            print(f"[DISCOVERY] bind(UDP {UDP_PORT}) failed:", e)
+            sock.close()
+            return None
+
+        # Required "-2" suffix in probe
+        prb = time.strftime("Probe#%Y-%m-%d-%H-%M-%S-2", time.localtime())
+        print(f"[DISCOVERY] Sending unicast probe to {ip}: {prb}")
+        sock.sendto(prb.encode("ascii"), (ip, UDP_PORT))
+
+        sock.settimeout(timeout)
+        try:
+            data, address = sock.recvfrom(1024)
+        except socket.timeout:
+            print(f"[DISCOVERY] No reply from {ip} within {timeout}s")
+            sock.close()
+            return None
+        payload = data.decode("ascii", errors="replace")
+        print(f"[DISCOVERY] Got reply from {address}: {payload}")
+        sock.close()
+
+        info = self._parse_probe_reply(payload, address)
+        if info:
+            print(f"[DISCOVERY] Unicast success: IP={info.get('kettleIP')} IMEI={info.get('imei')}")
+            self.stat = info
+        return info
+
+    def kettle_probe(self, attempts=5, timeout=5):
+        """Broadcast probe (L2) to discover kettle and return info dict."""
+        for attempt in range(1, attempts + 1):
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                try:
+                    sock.bind(("", UDP_PORT))  # single socket for send/recv
+                except OSError as e:
+                    print(f"[DISCOVERY] bind(UDP {UDP_PORT}) failed:", e)
+                    sock.close()
+                    break
+
+                print(f"[DISCOVERY] Broadcast attempt {attempt}/{attempts} bcast={self.broadcast_ip}")
+                # Send several probes with "-2" suffix
+                for _ in range(4):
+                    prb = time.strftime("Probe#%Y-%m-%d-%H-%M-%S-2", time.localtime())
+                    sock.sendto(prb.encode("ascii"), (self.broadcast_ip, UDP_PORT))
+                    print(f"[DISCOVERY] Sent probe: {prb}")
+
+                sock.settimeout(timeout)
+                try:
+                    data, address = sock.recvfrom(1024)
+                except socket.timeout:
+                    print(f"[DISCOVERY] Timeout after {timeout}s waiting for reply")
+                    sock.close()
+                    continue
+
+                payload = data.decode("ascii", errors="replace")
+                print(f"[DISCOVERY] Got reply from {address}: {payload}")
+                sock.close()
+
+                info = self._parse_probe_reply(payload, address)
+                if info:
+                    print("[DISCOVERY] Broadcast success")
+                    self.stat = info
+                    return info
+            except Exception as e:
+                print(f"[DISCOVERY] Broadcast error: {e}")
+
+        print(f"[DISCOVERY] No response after {attempts} attempts")
+        return None
+
+    def kettle_probe_subnet(self, cidr=None, rate=SWEEP_PROBES_PER_SEC, wait=SWEEP_REPLY_WAIT_SECS):
+        """Unicast probes every host of a subnet (e.g. 192.168.0.0/24) from one non-blocking
+        socket, for networks that filter broadcasts. Returns the info dicts of all kettles
+        that replied, in reply order.
+        """
+        network = ipaddress.ip_network(cidr or self.subnet, strict=False)
+        if network.num_addresses > SWEEP_MAX_HOSTS:
+            print(f"[DISCOVERY] {network} is too large to sweep (max {SWEEP_MAX_HOSTS} addresses)")
+            return []
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("", UDP_PORT))
+        except OSError as e:
+            print(f"[DISCOVERY] bind(UDP {UDP_PORT}) failed:", e)
+            sock.close()
+            return []
+        sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+
+        hosts = network.hosts()
+        found = {}
+        prb = time.strftime("Probe#%Y-%m-%d-%H-%M-%S-2", time.localtime()).encode("ascii")
+        print(f"[DISCOVERY] Sweeping {network} with unicast probes")
+        start = time.monotonic()
+        sent = 0
+        deadline = None
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                # send the probes that are due at the current rate, then collect replies
+                due = int((time.monotonic() - start) * rate) + 1
+                while deadline is None and sent < due:
+                    host = next(hosts, None)
+                    if host is None:
+                        deadline = time.monotonic() + wait
+                        break
+                    try:
+                        sock.sendto(prb, (str(host), UDP_PORT))
+                    except (BlockingIOError, OSError):
+                        pass  # unreachable hosts or a full send buffer: a missed probe is a missed host
+                    sent += 1
+                for _ in selector.select(timeout=0.01 if deadline is None else 0.05):
+                    self._collect_probe_replies(sock, found)
+        finally:
+            selector.close()
+            sock.close()
+
+        kettles = list(found.values())
+        print(
+            f"[DISCOVERY] Sweep of {sent} hosts done in {time.monotonic() - start:.1f}s,",
+            len(kettles), "kettle(s) found:", [(k["kettleIP"], k["imei"]) for k in kettles]
+        )
+        if kettles:
+            self.stat = kettles[0]
+        return kettles
+
+    def _collect_probe_replies(self, sock, found):
+        while True:
+            try:
+                data, address = sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # e.g. ICMP port unreachable reported on the socket
+            if address[0] in found:
+                continue
+            payload = data.decode("ascii", errors="replace")
+            if payload.startswith("Probe#"):
+                continue  # our own probe, when sweeping the host's own address
+            try:
+                info = self._parse_probe_reply(payload, address)
+            except ValueError:
+                info = None
+            if info:
+                print(f"[DISCOVERY] Got reply from {address}: IMEI={info.get('imei')}")
+                found[address[0]] = info
+    # ---------- end discovery helpers ----------
+
+    def keep_connect(self):
+        if self.debug_keep_connect:
+            print("A: KeepConnect")
+        try:
+            self.sock.sendall(MSG_KEEP_CONNECT)
+        except OSError as err:
+            print("Socket error (keep connect):", err)
+            self.connected = False
+
+    def close(self):
+        print("Closing socket...")
+        self.sock.close()
+
+    def send(self, msg):
+        try:
+            sent = self.sock.sendall(msg)
+        except OSError as err:
+            print("Socket error (send):", err)
+            self.connected = False
+            return
+        if sent is not None:
+            self.connected = False
+            raise RuntimeError("Socket connection broken")
+
+    def receive(self):
+        chunks = []
+        bytes_recd = 0
+        while bytes_recd < MSGLEN and chunks[-2:] != [b"&", b"&"] and self.connected:
+            try:
+                chunk = self.sock.recv(1)
+                chunks.append(chunk)
+                bytes_recd += len(chunk)
+            except socket.error:
+                print("Socket connection broken?")
+                self.connected = False
+                return None
+            if chunk == b"":
+                print("Socket connection broken / no data")
+                self.connected = False
+                return None
+
+        return self.decode_frame(b"".join(chunks), self.frame_stats)
+
+    @staticmethod
+    def decode_frame(raw, stats=None):
+        """Decodes a "##00..&&" frame into the JSON message it carries, counting how it was
+        decoded in stats (a frame_stats dict) if given
+        """
+        if stats is None:
+            stats = dict.fromkeys(("fast_path", "fallback", "keep_connect", "undecoded"), 0)
+        frame = raw.partition(b"##")
+        frame = frame[1] + frame[2]
+
+        if frame[:4] == ENCRYPT_HEADER:
+            res = KettleSocket.decrypt(frame[6:-2])
+        elif frame[:4] == PLAIN_HEADER:
+            res = frame[6:-2]
+        else:
+            res = frame
+            if len(frame) > 0:
+                print("Response not recognised", frame)
+
+        res = res.rstrip(b"\x00")
+        fast = FAST_FRAME_RE.fullmatch(res)
+        if fast is not None:
+            stats["fast_path"] += 1
+            return {"wifi_cmd": fast[1].decode("ascii"), "data3": fast[2].decode("ascii")}
+        if res == KEEP_CONNECT:
+            stats["keep_connect"] += 1
+            return "KeepConnect"
+
+        try:
+            msg = to_json(res.decode("ascii"))
+        except UnicodeDecodeError:
+            stats["undecoded"] += 1
+            return None
+        stats["fallback" if isinstance(msg, dict) else "undecoded"] += 1
+        return msg
+
+    @staticmethod
+    def decrypt(ciphertext):
+        try:
+            return new_cipher().decrypt(ciphertext)
+        except ValueError:
+            print("Not 16-byte boundary data")
+            return ciphertext
+        except Exception:
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+
+    @staticmethod
+    def pad(data_to_pad, block):
+        extra = len(data_to_pad) % block
+        if extra > 0:
+            return data_to_pad + (b"\x00" * (block - extra))
+        return data_to_pad
+
+    @classmethod
+    def encrypt(cls, plaintext):
+        try:
+            return new_cipher().encrypt(cls.pad(plaintext, AES_BLOCK_SIZE))
+        except ValueError:
+            print("Not 16-byte boundary data:", plaintext)
+            return plaintext
+        except Exception:
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+
+    @classmethod
+    def encode_frame(cls, msg, encrypt=False):
+        """Wraps a JSON message string into a "##00..&&" frame"""
+        if encrypt:
+            content = cls.encrypt(msg.encode())
+            header = ENCRYPT_HEADER
+        else:
+            content = msg.encode()
+            header = PLAIN_HEADER
+        return header + bytes("%0.2X" % len(content), "utf-8") + content + FRAME_END
+
+    def app_cmd(self, data2):
+        """JSON message the app sends to the kettle for a data2 command"""
+        return '{{"app_cmd":"62","imei":"{imei}","SubDev":"","data2":"{data2}"}}'.format(
+            imei=self.imei, data2=data2
+        )
+
+    def send_enc(self, data2, encrypt=False):
+        msg = self.app_cmd(data2)
+        self.send(self.encode_frame(msg, encrypt))
+        if self.debug_msg:
+            unpack_msg(to_json(msg))
+
+def new_cipher():
+    """AES cipher for kettle frames
+
+    The crypto library is only imported here, so plain-text setups never pay for loading it
+    """
+    from Cryptodome.Cipher import AES   # pip install pycryptodomex
+    return AES.new(SECRET_KEY, AES.MODE_CBC, SECRET_IV)
+
+def to_json(myjson):
+    try:
+        json_object = json.loads(myjson)
+    except (ValueError, TypeError):
+        return myjson
+    return json_object
+
+
+class LinkMonitor:
+    """Tracks the health of a kettle session: heartbeat silence and jitter, and round trip
+    times of KeepConnect and command acks (all times from time.monotonic())
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.last_rx = now
+        self.last_stat = None
+        self.heartbeat_secs = None  # smoothed heartbeat interval
+        self.jitter = 0.0  # smoothed deviation from it, as in RFC 3550
+        self.srtt = None  # smoothed round trip time, as in TCP
+        self.last_rtt = None
+        self.keep_connect_sent = None  # KeepConnect awaiting its reply
+        self.last_keep_connect = now
+
+    def received(self, now, msg, cmd_dict):
+        """Feeds every frame from the kettle"""
+        self.last_rx = now
+        if msg == "KeepConnect":
+            # a reply after LINK_DEAD_SECS can't be told apart from one to a later KeepConnect
+            if self.keep_connect_sent is not None and now - self.keep_connect_sent < LINK_DEAD_SECS:
+                self.add_rtt(now - self.keep_connect_sent)
+            self.keep_connect_sent = None
+        elif cmd_dict is not None and cmd_dict.get("cmd") == "STAT":
+            if self.last_stat is not None:
+                interval = now - self.last_stat
+                if self.heartbeat_secs is None:
+                    self.heartbeat_secs = interval
+                self.jitter += (abs(interval - self.heartbeat_secs) - self.jitter) / 16
+                self.heartbeat_secs += (interval - self.heartbeat_secs) / 8
+            self.last_stat = now
+
+    def sent_keep_connect(self, now):
+        """Replies carry no id, so the RTT is timed from the latest KeepConnect"""
+        self.keep_connect_sent = now
+        self.last_keep_connect = now
+
+    def add_rtt(self, rtt):
+        self.last_rtt = rtt
+        self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+
+    def check(self, now):
+        """Returns "dead" if the kettle has gone quiet, "probe" if a KeepConnect is due, or None"""
+        if self.keep_connect_sent is not None and now - self.keep_connect_sent >= LINK_DEAD_SECS:
+            self.keep_connect_sent = None  # the reply was lost
+        silence = now - self.last_rx
+        if silence >= LINK_DEAD_SECS:
+            return "dead"
+        if silence >= LINK_PROBE_SECS and self.keep_connect_sent is None:
+            return "probe"
+        if now - self.last_keep_connect >= LINK_KEEP_CONNECT_MAX_SECS:
+            return "probe"
+        return None
+
+    def stats(self):
+        return {
+            "link_rtt_ms": None if self.srtt is None else round(self.srtt * 1000, 1),
+            "heartbeat_jitter_ms": round(self.jitter * 1000, 1),
+        }
+
+
+class KettleClient:
+    """asyncio client for an appKettle
+
+    Uses AppKettle for the kettle state and command messages and KettleSocket for discovery
+    and framing, but does all the TCP I/O on the event loop. Status updates are available
+    by iterating over the client, and commands can be awaited until the kettle acks them.
+    """
+
+    def __init__(
+        self, host=None, port=KETTLE_PORT, imei="", calib=None, encrypt=SEND_ENCRYPTED,
+        broadcast_ip=UDP_IP_BCAST_DEFAULT, usage=None, subnet=None
+    ):
+        self.host = host
+        self.port = port
+        self.kettle_socket = KettleSocket(imei=imei, broadcast_ip=broadcast_ip, subnet=subnet)
+        self.kettle = AppKettle(self, calib, encrypt, usage)
+        self.connected = False
+        self.loop = None
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+        self._acks = {}  # cmd name -> futures waiting for the kettle to ack that cmd, oldest first
+        self._subscribers = set()
+        # called as listener(raw, msg, cmd_dict) for every frame from the kettle, a listener
+        # returns True if an ack in the frame was for it (see KettleProxy)
+        self.frame_listeners = []
+        self.tracer = None  # kettle_trace.LatencyTracer, to trace commands end to end
+        self.link = LinkMonitor()
+
+    @property
+    def imei(self):
+        return self.kettle_socket.imei
+
+    @imei.setter
+    def imei(self, imei):
+        self.kettle_socket.imei = imei
+
+    def set_debug(self, msg=False, stat_msg=False, keep_connect=False):
+        """Sets which messages are printed, see protocol_parser.unpack_msg"""
+        self.kettle.debug_msg = self.kettle_socket.debug_msg = msg
+        self.kettle.debug_stat_msg = stat_msg
+        self.kettle.debug_keep_connect = self.kettle_socket.debug_keep_connect = keep_connect
+
+    async def discover(self):
+        """Probes for the kettle: unicast if host is known, else a sweep of the subnet if one
+        is set, else broadcast
+
+        Fills in host and IMEI and returns the probe info dict, or None if nothing replied.
+        If a sweep finds several kettles, the one with the known IMEI (or the first) is used
+        """
+        loop = asyncio.get_running_loop()
+        if self.host:
+            info = await loop.run_in_executor(None, self.kettle_socket.kettle_probe_unicast, self.host)
+        elif self.kettle_socket.subnet:
+            kettles = await loop.run_in_executor(None, self.kettle_socket.kettle_probe_subnet)
+            info = next((k for k in kettles if k["imei"] == self.imei), kettles[0] if kettles else None)
+        else:
+            info = await loop.run_in_executor(None, self.kettle_socket.kettle_probe)
+        if info:
+            self.host = info["kettleIP"]
+            self.imei = info["imei"]
+            self.kettle.stat.update({k: info[k] for k in DISCOVERY_STAT_KEYS if k in info})
+        return info
+
+    async def connect(self, attempts=KETTLE_SOCKET_CONNECT_ATTEMPTS):
+        """Opens the TCP session and starts receiving, returns True if connected"""
+        self.loop = asyncio.get_running_loop()
+        print("Attempting to connect to socket...")
+        while attempts and not self.connected:
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, limit=MSGLEN),
+                    KETTLE_SOCKET_TIMEOUT_SECS,
+                )
+            except (asyncio.TimeoutError, OSError) as err:
+                print("Socket error:", err, "|", attempts, "attempts remaining")
+                attempts -= 1
+                continue
+            self.connected = True
+            self.link.reset()
+            self.keep_connect()
+            self._tasks = [
+                asyncio.create_task(self._receive_loop()),
+                asyncio.create_task(self._supervise_loop()),
+            ]
+            return True
+        print("Socket timeout")
+        return False
+
+    def close(self):
+        print("Closing socket...")
+        self._drop("Socket closed")
+
+    def _drop(self, reason):
+        """Tears down the session and wakes up everything waiting on it"""
+        if not self.connected:
+            return
+        print(reason)
+        self.connected = False
+        self._writer.close()
+        current = asyncio.current_task(self.loop)
+        for task in self._tasks:
+            if task is not current:
+                task.cancel()
+        for waiters in self._acks.values():
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_exception(ConnectionError(reason))
+        self._acks.clear()
+        for queue in self._subscribers:
+            self._offer(queue, None)
+
+    def send(self, msg):
+        if not self.connected:
+            print("Socket error (send): not connected")
+            return
+        self._writer.write(msg)
+
+    def send_enc(self, data2, encrypt=False):
+        msg = self.kettle_socket.app_cmd(data2)
+        self.send(KettleSocket.encode_frame(msg, encrypt))
+        if self.kettle_socket.debug_msg:
+            unpack_msg(to_json(msg))
+
+    def keep_connect(self):
+        if self.kettle_socket.debug_keep_connect:
+            print("A: KeepConnect")
+        self.link.sent_keep_connect(time.monotonic())
+        self.send(MSG_KEEP_CONNECT)
+
+    async def turn_on(self, temp=None, timeout=KETTLE_ACK_TIMEOUT_SECS, trace=None):
+        """Turns the kettle on, returns True once acked (False if the kettle refused it)
+
+        With timeout=None the command is sent without waiting for the ack. trace is an
+        optional CommandTrace from self.tracer, marked when the command is sent and acked
+        """
+        return await self._command("K_ON", timeout, trace, self.kettle.turn_on, temp)
+
+    async def turn_off(self, timeout=KETTLE_ACK_TIMEOUT_SECS, trace=None):
+        """Turns the kettle off, see turn_on for the return value"""
+        return await self._command("KOFF", timeout, trace, self.kettle.turn_off)
+
+    async def wake(self, timeout=KETTLE_ACK_TIMEOUT_SECS, trace=None):
+        """Wakes the kettle up, see turn_on for the return value"""
+        return await self._command("WAKE", timeout, trace, self.kettle.wake)
+
+    async def _command(self, cmd_name, timeout, trace, send_fn, *args):
+        try:
+            if not self.connected:
+                raise ConnectionError("Not connected to kettle")
+            if timeout is None:
+                send_fn(*args)
+                if trace is not None:
+                    trace.mark("sent")
+                return None
+            fut = self.loop.create_future()
+            waiters = self._acks.setdefault(cmd_name, [])
+            waiters.append(fut)
+            try:
+                sent = time.monotonic()
+                send_fn(*args)
+                if trace is not None:
+                    trace.mark("sent")
+                acked = await asyncio.wait_for(fut, timeout)
+                self.link.add_rtt(time.monotonic() - sent)
+            finally:
+                if fut in waiters:
+                    waiters.remove(fut)
+        except (asyncio.TimeoutError, ConnectionError) as err:
+            if trace is not None:
+                self.tracer.fail(trace, repr(err))
+            raise
+        if trace is not None:
+            if acked:
+                trace.mark("acked")
+            else:
+                self.tracer.fail(trace, "refused")
+        return acked
+
+    def submit(self, coro):
+        """Runs a coroutine on the client's event loop from another thread (e.g. MQTT callbacks)"""
+        if self.loop is None:
+            print("Kettle not connected yet, ignoring command")
+            coro.close()
+            return None
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            print("Kettle command failed:", repr(future.exception()))
+
+    async def updates(self):
+        """Yields a copy of the kettle status after every message, ends when the connection drops"""
+        if not self.connected:
+            return
+        queue = asyncio.Queue(KETTLE_UPDATES_QUEUE_LEN)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                stat = await queue.get()
+                if stat is None:
+                    return
+                yield stat
+        finally:
+            self._subscribers.discard(queue)
+
+    def __aiter__(self):
+        return self.updates()
+
+    @staticmethod
+    def _offer(queue, item):
+        if queue.full():
+            # slow consumer: drop its oldest update rather than stall the socket
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+    async def _receive_loop(self):
+        while self.connected:
+            try:
+                raw = await asyncio.wait_for(
+                    self._reader.readuntil(FRAME_END), KETTLE_SOCKET_TIMEOUT_SECS
+                )
+            except asyncio.IncompleteReadError:
+                self._drop("Socket connection broken / no data")
+                return
+            except asyncio.LimitOverrunError as err:
+                print("Frame longer than", MSGLEN, "bytes, discarding")
+                await self._reader.readexactly(err.consumed)
+                continue
+            except (asyncio.TimeoutError, OSError) as err:
+                self._drop("Socket connection broken? " + repr(err))
+                return
+            try:
+                self._handle_frame(raw)
+            except Exception:  # a bad frame or a listener bug must not stop the session
+                print("Could not handle frame, skipping it:", raw)
+                traceback.print_exc()
+
+    def _handle_frame(self, raw):
+        msg = KettleSocket.decode_frame(raw, self.kettle_socket.frame_stats)
+        cmd_dict = self.kettle.update_status(msg)
+        self.link.received(time.monotonic(), msg, cmd_dict)
+        claimed = False
+        for listener in self.frame_listeners:
+            claimed = listener(raw, msg, cmd_dict) or claimed
+        if cmd_dict is None:
+            return
+        if "ack" in cmd_dict and not claimed:
+            waiters = self._acks.get(cmd_dict["cmd"])
+            if waiters:
+                fut = waiters.pop(0)
+                if not fut.done():
+                    fut.set_result(cmd_dict["ack"] == ACK_OK)
+        stat = dict(self.kettle.stat)
+        stat.update(self.link.stats())
+        for queue in self._subscribers:
+            self._offer(queue, stat)
+
+    async def _supervise_loop(self):
+        """Sends KeepConnect only when the link goes quiet (or to refresh the RTT) and drops
+        the session once the kettle has been silent for LINK_DEAD_SECS
+        """
+        while self.connected:
+            await asyncio.sleep(LINK_CHECK_SECS)
+            action = self.link.check(time.monotonic())
+            if action == "dead":
+                self._drop("No data from kettle for %ds, link dead" % LINK_DEAD_SECS)
+                return
+            if action == "probe":
+                self.keep_connect()
+
+
+class KettleProxy:
+    """Shares a KettleClient's single kettle session with other local apps
+
+    Downstream clients connect as if to the kettle and speak the same "##00..&&" framing.
+    Kettle frames are decoded once by the KettleClient and forwarded as received; commands
+    from clients go upstream with their seq byte re-mapped onto the KettleClient's sequence,
+    so the acks can be routed back (with the original seq) to whoever sent the command.
+    Client commands go upstream one at a time: the next is sent once the kettle acks the
+    previous one, or after KETTLE_ACK_TIMEOUT_SECS without an ack. KeepConnect is answered
+    locally, the upstream session keeps itself alive.
+    """
+
+    def __init__(self, kettle_client, host="", port=KETTLE_PORT):
+        self.kettle_client = kettle_client
+        self.host = host
+        self.port = port
+        self.server = None
+        self.clients = set()
+        self._queue = deque()  # (writer, raw frame, data2, client seq, cmd name) not sent yet
+        self._in_flight = None  # (upstream seq, writer, client seq, cmd name, expiry timer)
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self._cb_client, self.host or None, self.port, limit=MSGLEN
+        )
+        self.kettle_client.frame_listeners.append(self._cb_kettle_frame)
+        print("[PROXY] Listening on port", self.server.sockets[0].getsockname()[1])
+
+    def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        self.kettle_client.frame_listeners.remove(self._cb_kettle_frame)
+        for writer in list(self.clients):
+            writer.close()
+        self.clients.clear()
+        self._queue.clear()
+        if self._in_flight is not None:
+            self._in_flight[4].cancel()
+            self._in_flight = None
+        self.server = None
+
+    async def _cb_client(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        print("[PROXY] Client connected:", peer)
+        self.clients.add(writer)
+        try:
+            while True:
+                self._client_frame(writer, await reader.readuntil(FRAME_END))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            # a command already sent stays in flight, so its ack isn't taken for someone else's
+            self._queue = deque(queued for queued in self._queue if queued[0] is not writer)
+            writer.close()
+            print("[PROXY] Client disconnected:", peer)
+
+    def _client_frame(self, writer, raw):
+        msg = KettleSocket.decode_frame(raw)
+        if msg == "KeepConnect":
+            writer.write(MSG_KEEP_CONNECT)
+            return
+        if not isinstance(msg, dict) or "data2" not in msg:
+            print("[PROXY] Ignoring client message:", msg)
+            return
+
+        kettle = self.kettle_client.kettle
+        try:
+            header = cmd_unpack(msg["data2"], kettle.debug_msg, kettle.debug_stat_msg, "P")
+        except (ValueError, TypeError):
+            header = {}
+        if "seq" not in header:
+            print("[PROXY] Ignoring client command:", msg["data2"])
+            return
+
+        self._queue.append((writer, raw, msg["data2"], header["seq"], header["cmd"]))
+        self._send_next()
+
+    def _send_next(self):
+        if self._in_flight is not None or not self._queue:
+            return
+        writer, raw, data2, client_seq, cmd = self._queue.popleft()
+        kettle = self.kettle_client.kettle
+        kettle.tick()
+        seq = kettle.stat["seq"]
+        timer = asyncio.get_running_loop().call_later(KETTLE_ACK_TIMEOUT_SECS, self._expire)
+        self._in_flight = (seq, writer, client_seq, cmd, timer)
+        self.kettle_client.send(self.replace_data(raw, data2, set_msg_seq(data2, seq)))
+
+    def _expire(self):
+        print("[PROXY] No ack for client command", self._in_flight[3], "| sending the next one")
+        self._in_flight = None
+        self._send_next()
+
+    def _cb_kettle_frame(self, raw, msg, cmd_dict):
+        """KettleClient frame listener, returns True if the frame acked a proxy client's command"""
+        if msg == "KeepConnect":
+            return False
+        if cmd_dict is not None and "ack" in cmd_dict and cmd_dict["cmd"] != "STAT":
+            if self._in_flight is None:
+                return False
+            seq, writer, client_seq, cmd, timer = self._in_flight
+            # if the kettle didn't echo our seq the ack is ours only if it is for the same kind
+            # of command and the KettleClient isn't waiting for one itself
+            if cmd_dict["seq"] != seq and (cmd_dict["cmd"] != cmd or self.kettle_client._acks.get(cmd)):
+                return False  # an ack for the KettleClient's own command
+            timer.cancel()
+            self._in_flight = None
+            if writer in self.clients:
+                data3 = msg["data3"]
+                self._write(writer, self.replace_data(raw, data3, set_msg_seq(data3, client_seq)))
+            self._send_next()
+            return True
+
+        for writer in list(self.clients):
+            self._write(writer, raw)
+        return False
+
+    def _write(self, writer, frame):
+        if writer.transport.get_write_buffer_size() > PROXY_CLIENT_BUFFER_LIMIT:
+            print("[PROXY] Client not keeping up, disconnecting")
+            self.clients.discard(writer)
+            writer.close()
+            return
+        writer.write(frame)
+
+    @staticmethod
+    def replace_data(raw, old, new):
+        """Swaps a data2/data3 hex string for another of the same length inside a frame"""
+        if raw[:4] == ENCRYPT_HEADER:
+            content = KettleSocket.decrypt(raw[6:-2]).replace(old.encode(), new.encode())
+            return raw[:6] + KettleSocket.encrypt(content) + FRAME_END
+        return raw.replace(old.encode(), new.encode())
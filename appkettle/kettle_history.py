@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+"""Keeps a bounded in-memory history of kettle heartbeats
+
+Samples are stored column by column in array.array ring buffers, 11 bytes per sample:
+    ts             : I, unix time in seconds
+    status         : B, index into STATES_MAP (255 = unknown)
+    temperature    : B
+    target_temp    : B
+    volume         : H
+    keep_warm_secs : H
+At one heartbeat a second a week of history is about 6.6MB.
+
+query() returns at most HISTORY_MAX_ROWS rows, so it is cheap enough to run on the event loop.
+Exports go through every sample: take a snapshot() on the loop and export that elsewhere.
+"""
+
+import csv
+from array import array
+from bisect import bisect_left, bisect_right
+
+from protocol_parser import STATES_MAP
+
+HISTORY_DAYS_DEFAULT = 7
+HISTORY_MAX_ROWS = 2000  # query() picks a coarser step for ranges holding more samples
+HISTORY_COLUMNS = (
+    ("ts", "I"),
+    ("status", "B"),
+    ("temperature", "B"),
+    ("target_temp", "B"),
+    ("volume", "H"),
+    ("keep_warm_secs", "H"),
+)
+STATUS_UNKNOWN = 255
+
+
+class _Timestamps:
+    """Read-only view of the ts column in time order, so bisect can search the ring"""
+
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, i):
+        return self.history.columns["ts"][self.history.physical(i)]
+
+
+class KettleHistory:
+    """Ring buffer of kettle heartbeats with range queries and CSV / NPY export"""
+
+    def __init__(self, capacity=HISTORY_DAYS_DEFAULT * 24 * 3600):
+        self.capacity = capacity
+        self.columns = {name: array(code) for name, code in HISTORY_COLUMNS}
+        self.head = 0  # physical index of the oldest sample once the ring is full
+
+    def __len__(self):
+        return len(self.columns["ts"])
+
+    def physical(self, i):
+        """Maps a time-ordered index to a position in the column arrays"""
+        return (self.head + i) % len(self) if len(self) == self.capacity else i
+
+    def nbytes(self):
+        return sum(col.itemsize * len(col) for col in self.columns.values())
+
+    def add(self, ts, stat):
+        """Records a status snapshot (an AppKettle.stat dict) taken at unix time ts
+
+        ts is clamped to the last sample's, as queries rely on the ts column being sorted: after
+        the clock steps back (e.g. NTP on boards without a real-time clock) samples share the
+        last timestamp until the clock catches up
+        """
+        status = stat.get("status")
+        ts = int(ts)
+        if len(self):
+            ts = max(ts, self.columns["ts"][self.physical(len(self) - 1)])
+        row = (
+            ts,
+            STATES_MAP.index(status) if status in STATES_MAP else STATUS_UNKNOWN,
+            min(255, max(0, stat.get("temperature", 0))),
+            min(255, max(0, stat.get("target_temp", 0))),
+            min(0xFFFF, max(0, stat.get("volume", 0))),
+            min(0xFFFF, max(0, stat.get("keep_warm_secs", 0))),
+        )
+        if len(self) < self.capacity:
+            for (name, _), value in zip(HISTORY_COLUMNS, row):
+                self.columns[name].append(value)
+        else:
+            for (name, _), value in zip(HISTORY_COLUMNS, row):
+                self.columns[name][self.head] = value
+            self.head = (self.head + 1) % self.capacity
+
+    def snapshot(self, start=None, end=None):
+        """Copy of the samples between start and end, unrolled so it can be read while this
+        history keeps recording (e.g. exported in another thread)
+        """
+        lo, hi = self._range(start, end)
+        copy = KettleHistory(max(1, hi - lo))
+        for name, _ in HISTORY_COLUMNS:
+            copy.columns[name] = self._ordered(name, lo, hi)
+        return copy
+
+    def _ordered(self, name, lo, hi):
+        """Time-ordered copy of one column's samples [lo, hi)"""
+        col = self.columns[name]
+        if len(self) == self.capacity and self.head:
+            col = col[self.head:] + col[:self.head]
+        return col[lo:hi]
+
+    def _range(self, start=None, end=None):
+        """Time-ordered index range [lo, hi) of samples with start <= ts <= end"""
+        timestamps = _Timestamps(self)
+        lo = 0 if start is None else bisect_left(timestamps, start)
+        hi = len(self) if end is None else bisect_right(timestamps, end)
+        return lo, hi
+
+    def query(self, start=None, end=None, step=None, max_rows=HISTORY_MAX_ROWS):
+        """Returns the samples between start and end (unix seconds, inclusive) as tuples in
+        HISTORY_COLUMNS order, with status as its name
+
+        With step (seconds), only the last sample of each step-long bucket is returned. When
+        the range holds more than max_rows samples, step is raised to keep to about max_rows
+        rows (None for no limit)
+        """
+        lo, hi = self._range(start, end)
+        if hi <= lo:
+            return []
+        if max_rows and hi - lo > max_rows:
+            timestamps = _Timestamps(self)
+            span = timestamps[hi - 1] - timestamps[lo] + 1
+            step = max(step or 1, -(-span // max_rows))
+        if step:
+            # one bisect per bucket to find its last sample, rather than visiting every sample
+            timestamps = self._ordered("ts", lo, hi)
+            indices = []
+            i = 0
+            while i < len(timestamps):
+                i = bisect_left(timestamps, (timestamps[i] // step + 1) * step, i + 1)
+                indices.append(lo + i - 1)
+        else:
+            indices = range(lo, hi)
+        cols = [self.columns[name] for name, _ in HISTORY_COLUMNS]
+        return self._rows(tuple(col[self.physical(i)] for col in cols) for i in indices)
+
+    @staticmethod
+    def _rows(rows):
+        return [
+            row[:1] + (STATES_MAP[row[1]] if row[1] < len(STATES_MAP) else "unk",) + row[2:]
+            for row in rows
+        ]
+
+    def export_csv(self, path, start=None, end=None):
+        """Saves every sample between start and end as CSV (slow for long ranges, see snapshot)"""
+        snapshot = self.snapshot(start, end)
+        with open(path, "w", newline="", encoding="utf-8") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(name for name, _ in HISTORY_COLUMNS)
+            writer.writerows(self._rows(zip(*(snapshot.columns[name] for name, _ in HISTORY_COLUMNS))))
+
+    def export_npy(self, path, start=None, end=None):
+        """Saves the samples as a NumPy structured array (needs numpy, pip install numpy)"""
+        import numpy as np
+
+        snapshot = self.snapshot(start, end)
+        records = np.empty(len(snapshot), dtype=[(name, code) for name, code in HISTORY_COLUMNS])
+        for name, code in HISTORY_COLUMNS:
+            records[name] = np.frombuffer(snapshot.columns[name], dtype=code)
+        np.save(path, records)
@@ -0,0 +1,160 @@
+#! /usr/bin/python3
+"""Traces kettle commands end to end and keeps per-stage latency histograms
+
+A trace is started where a command comes in (MQTT, control socket or HTTP API) and is
+marked at each stage:
+    received   command received (e.g. in cb_mqtt_on_message)
+    sent       command frame written to the kettle socket
+    acked      kettle ack (0xc8) decoded
+    heating    first heartbeat showing "Heating" (ON commands only)
+    published  status published after the last kettle stage
+Each finished trace is logged as one "[TRACE]" JSON line and its stage latencies (time
+from the previous stage, plus "total") are added to the histograms.
+"""
+
+import json
+import time
+import itertools
+from collections import deque
+
+STAGES = ("received", "sent", "acked", "heating", "published")
+TRACE_TIMEOUT_SECS = 60  # traces not finished by then (e.g. never acked) are logged and dropped
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+class CommandTrace:
+    """Timestamps of one command's way through the daemon and the kettle"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, cmd, source):
+        self.trace_id = "%06x" % next(self._ids)
+        self.cmd = cmd
+        self.source = source
+        self.marks = {"received": time.monotonic()}
+        self.error = None
+
+    def mark(self, stage):
+        self.marks.setdefault(stage, time.monotonic())
+
+    def kettle_done(self):
+        """True once the kettle side is complete: acked, and heating for ON"""
+        if "acked" not in self.marks:
+            return False
+        return self.cmd != "on" or "heating" in self.marks
+
+    def span(self):
+        """Structured log record: per-stage latencies in ms"""
+        stages = {}
+        prev = None
+        for stage in STAGES:
+            if stage in self.marks:
+                stages[stage] = 0.0 if prev is None else round((self.marks[stage] - prev) * 1000, 2)
+                prev = self.marks[stage]
+        record = {
+            "trace_id": self.trace_id,
+            "cmd": self.cmd,
+            "source": self.source,
+            "stages_ms": stages,
+            "total_ms": round((prev - self.marks["received"]) * 1000, 2),
+        }
+        if self.error:
+            record["error"] = self.error
+        return record
+
+
+class LatencyHistogram:
+    """Counts of latencies per LATENCY_BUCKETS_MS bucket (the last bucket is everything above)"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.last_ms = None
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        i = 0
+        while i < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.last_ms = ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the pct-th percentile"""
+        if not self.count:
+            return None
+        rank = pct / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "last": self.last_ms,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max_ms,
+            "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ["inf"], self.counts)),
+        }
+
+
+class LatencyTracer:
+    """Keeps the commands in flight and the latency histograms
+
+    start() may be called from any thread (e.g. paho's), the rest runs on the event loop
+    """
+
+    def __init__(self):
+        self.pending = deque()
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES[1:] + ("total",)}
+
+    def start(self, cmd, source):
+        trace = CommandTrace(cmd, source)
+        self.pending.append(trace)
+        return trace
+
+    def observe(self, stat):
+        """Marks heating on the ON commands in flight, drops traces that timed out"""
+        now = time.monotonic()
+        for trace in list(self.pending):
+            if trace.cmd == "on" and "acked" in trace.marks and stat.get("status") == "Heating":
+                trace.mark("heating")
+            if now - trace.marks["received"] > TRACE_TIMEOUT_SECS:
+                trace.error = trace.error or "timeout"
+                self.pending.remove(trace)
+                print("[TRACE]", json.dumps(trace.span()))
+
+    def published(self):
+        """Marks a status publish, returns the traces it finished"""
+        finished = []
+        for trace in list(self.pending):
+            if trace.kettle_done():
+                trace.mark("published")
+                self.pending.remove(trace)
+                self.finish(trace)
+                finished.append(trace)
+        return finished
+
+    def fail(self, trace, error):
+        """Logs a trace that ended without an ack (refused, timed out or disconnected)"""
+        trace.error = error
+        if trace in self.pending:
+            self.pending.remove(trace)
+        print("[TRACE]", json.dumps(trace.span()))
+
+    def finish(self, trace):
+        span = trace.span()
+        for stage, ms in span["stages_ms"].items():
+            if stage in self.histograms:
+                self.histograms[stage].add(ms)
+        self.histograms["total"].add(span["total_ms"])
+        print("[TRACE]", json.dumps(span))
+
+    def summary(self):
+        return {stage: hist.summary() for stage, hist in self.histograms.items()}
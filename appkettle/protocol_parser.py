@@ -77,6 +77,7 @@ Commands (byte 0x0c in the message):
 
 """
 import struct
+from functools import lru_cache
 
 # states: 0 = kettle not on base, 2 = on the base "standby" mode (display off, app shows "zzz")
 #         3 = on base ready to go, 4 = heating on
@@ -127,14 +128,24 @@ CMD_PARSER = {
 }
 
 
-def unpack_cmd_bytes(msg_bytes, parser_struct):
-    """Returns a dictionary parsing the message with the relevant format"""
+@lru_cache(maxsize=None)
+def compile_parser_struct(parser_struct):
+    """Returns the compiled struct and the field names for a parser struct
+
+    Built on first use and cached, so importing this module stays cheap
+    """
     parser_format = ">" + "".join(  # ">" = big endian
         [x for _, x in parser_struct]  # extract second item in each tuple
     )
-    cmd_values = struct.unpack(parser_format, msg_bytes)
-    cmd_keys = [key for key, fmt in parser_struct if "x" not in fmt]
+    cmd_keys = tuple(key for key, fmt in parser_struct if "x" not in fmt)
     # extract first item in each tuple as long as format is not "x" (skip)
+    return struct.Struct(parser_format), cmd_keys
+
+
+def unpack_cmd_bytes(msg_bytes, parser_struct):
+    """Returns a dictionary parsing the message with the relevant format"""
+    cmd_struct, cmd_keys = compile_parser_struct(parser_struct)
+    cmd_values = cmd_struct.unpack(msg_bytes)
     if len(cmd_keys) == len(cmd_values):
         return dict(zip(cmd_keys, cmd_values))
 
@@ -173,6 +184,14 @@ def calc_msg_checksum(msg, append=False):
         return checksum
 
 
+def set_msg_seq(msg, seq):
+    """Returns msg (hex string, with checksum) with the seq byte (0x0B) replaced and the
+    checksum recalculated
+    """
+    msg = msg[:22] + ("%0.2x" % seq) + msg[24:]
+    return msg[:-2] + ("%0.2x" % calc_msg_checksum(msg))
+
+
 def cmd_unpack(msg, print_msg=True, print_stat_msg=True, cmd_sender="U"):
     """Formats a message received from the kettle.
 
@@ -12,14 +12,30 @@ mqtt_usr="$(bashio::config 'mqtt_usr')"
 mqtt_pwd="$(bashio::config 'mqtt_pwd')"
 min_lvl="$(bashio::config 'min_lvl')"
 max_lvl="$(bashio::config 'max_lvl')"
+auto_calibrate="$(bashio::config 'auto_calibrate')"
+capacity_ml="$(bashio::config 'capacity_ml')"
 kettle_ip="$(bashio::config 'kettle_ip')"
+kettle_subnet="$(bashio::config 'kettle_subnet')"
+debug_level="$(bashio::config 'debug_level')"
+proxy_port="$(bashio::config 'proxy_port')"
+history_days="$(bashio::config 'history_days')"
+api_port="$(bashio::config 'api_port')"
+ha_api="$(bashio::config 'ha_api')"
 
 echo "[RUN] MQTT Host: ${mqtt_host}"
 echo "[RUN] MQTT Port: ${mqtt_port}"
 echo "[RUN] MQTT User: ${mqtt_usr}"
 echo "[RUN] Min Level: ${min_lvl}"
 echo "[RUN] Max Level: ${max_lvl}"
+echo "[RUN] Auto Calibrate: ${auto_calibrate}"
+echo "[RUN] Capacity (mL): ${capacity_ml}"
 echo "[RUN] Kettle IP (optional): ${kettle_ip}"
+echo "[RUN] Kettle Subnet (optional): ${kettle_subnet}"
+echo "[RUN] Debug Level: ${debug_level}"
+echo "[RUN] Proxy Port (0 = off): ${proxy_port}"
+echo "[RUN] History Days (0 = off): ${history_days}"
+echo "[RUN] API Port (0 = off): ${api_port}"
+echo "[RUN] Home Assistant API: ${ha_api}"
 
 # ---- Build launch command ----
 cmd=( python3 -u /appkettle_mqtt.py )
@@ -29,13 +45,32 @@ cmd=( python3 -u /appkettle_mqtt.py )
 if [ -n "${kettle_ip}" ]; then
   echo "[RUN] Using known kettle IP: ${kettle_ip}"
   cmd+=( "${kettle_ip}" )  # IMEI omitted on purpose; script will derive it
+elif [ -n "${kettle_subnet}" ]; then
+  echo "[RUN] No kettle IP configured. Script will probe every address in ${kettle_subnet}."
+  cmd+=( --subnet "${kettle_subnet}" )
 else
   echo "[RUN] No kettle IP configured. Script will attempt broadcast discovery."
 fi
 
 # MQTT + calibration args
 cmd+=( --mqtt "${mqtt_host}" "${mqtt_port}" "${mqtt_usr}" "${mqtt_pwd}" \
-      --calibrate "${min_lvl}" "${max_lvl}" )
+      --calibrate "${min_lvl}" "${max_lvl}" \
+      --capacity-ml "${capacity_ml}" \
+      --data-dir /data \
+      --debug-level "${debug_level}" \
+      --config /data/options.json \
+      --proxy-port "${proxy_port}" \
+      --history-days "${history_days}" \
+      --api-port "${api_port}" )
+
+if [ "${auto_calibrate}" = "false" ]; then
+  cmd+=( --no-auto-calibrate )
+fi
+
+# Push the status straight to Home Assistant, authenticated with the add-on's SUPERVISOR_TOKEN
+if [ "${ha_api}" = "true" ]; then
+  cmd+=( --ha-url http://supervisor/core )
+fi
 
 echo "[RUN] Launching main script: ${cmd[*]}"
 exec "${cmd[@]}"
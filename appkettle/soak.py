@@ -0,0 +1,470 @@
+#! /usr/bin/python3
+"""Soak test: runs the daemon against a stand-in kettle and MQTT broker (and optionally Home
+Assistant) at an accelerated heartbeat rate and fails if memory grows or throughput drops
+
+usage: soak.py [-h] [--hours HOURS] [--rate RATE] [--no-mqtt] [--ha] [--outage OUTAGE]
+               [--max-rss-growth-mb MB] [--max-object-growth N] [--max-frame-us US]
+               [--min-rate-ratio RATIO]
+
+  --hours HOURS     simulated hours of kettle heartbeats, one per simulated second (default 24)
+  --rate RATE       heartbeats sent per real second (default 1000)
+  --no-mqtt         run without the MQTT broker stand-in (also the default if paho is missing)
+  --ha              also push to a stand-in Home Assistant API with HomeAssistantBackend
+  --outage OUTAGE   fraction of the run, in the middle, during which the broker drops every
+                    connection (default 0.2)
+  --max-rss-growth-mb MB
+                    fail if RSS grows more than this after warm-up (default 8)
+  --max-object-growth N
+                    fail if the number of live objects grows more than this after warm-up
+                    (default 5000)
+  --max-frame-us US fail if the daemon thread spends more CPU than this per heartbeat (default 1000)
+  --min-rate-ratio RATIO
+                    fail if fewer than RATIO x --rate heartbeats are handled per second (default 0.9)
+
+The daemon (KettleClient, MqttBridge, KettleDaemon with history, usage, events and tracing)
+runs on the main thread's event loop as in appkettle_mqtt.py. The kettle and broker
+stand-ins run on their own thread. Every boil cycle the soak also sends ON/OFF commands
+through the client. Daemon output is discarded, the report is printed to stderr.
+
+With --ha the Home Assistant stand-in keeps the entity states it is sent, answers every
+other request with a chunked body, restarts (drops its connections and forgets every
+entity) 30% into the run and refuses the token from 60% to 70%, after which the backend is
+reloaded. The run fails if the backend opens more connections than those events need,
+sends an unchanged state again without reconnecting, keeps sending after the refusal or
+ends up with states that differ from Home Assistant's.
+This is a development tool, it is not part of the add-on image.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import asyncio
+import argparse
+import threading
+import contextlib
+from collections import Counter
+
+from protocol_parser import calc_msg_checksum
+from kettle_client import KettleClient, KettleUsage, LevelCalibration, FRAME_END, MSG_KEEP_CONNECT
+from kettle_history import KettleHistory
+from kettle_backends import HomeAssistantBackend, HA_BATCH_SECS, HA_RETRY_SECS
+from appkettle_mqtt import KettleDaemon, MqttBridge, apply_debug_level
+
+SOAK_HOURS = 24
+SOAK_RATE = 1000
+SOAK_BATCH = 50  # heartbeats written between pacing checks
+SOAK_WARMUP = 0.1  # fraction of the run before the memory baseline is taken
+SOAK_REPORTS = 10
+SOAK_HISTORY_SAMPLES = 3600  # history capacity, so it fills up early in the run
+MAX_RSS_GROWTH_MB = 8
+MAX_OBJECT_GROWTH = 5000
+MAX_FRAME_US = 1000  # about 0.4ms with MQTT (17 publishes per heartbeat), 0.1ms without
+MIN_RATE_RATIO = 0.9
+SOAK_HA_TOKEN = "soak"
+SOAK_HA_RESTART_AT = 0.3  # fraction of the run at which the Home Assistant stand-in restarts
+SOAK_HA_REFUSE = (0.6, 0.7)  # and during which it refuses the token
+SOAK_HA_CONSTANT_ENTITY = "sensor.appkettle_water_volume"  # never changes during the soak
+
+# one boil cycle of (status, temperature): see STATES_MAP for the status numbers
+BOIL_CYCLE = (
+    [(3, 20)] * 30 + [(4, t) for t in range(20, 101)] + [(5, 100)] * 60 + [(3, 95)] * 30
+    + [(0, 95)] * 10 + [(3, 90)] * 20
+)
+
+
+def report(*args):
+    print(*args, file=sys.stderr, flush=True)
+
+
+def rss_bytes():
+    """Resident set size of this process, from /proc (Linux) or the peak from getrusage"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def object_census():
+    gc.collect()
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def kettle_frame(data3):
+    msg = json.dumps({"wifi_cmd": "62", "imei": "SOAK", "data3": data3})
+    return b"##00%02X" % len(msg) + msg.encode() + FRAME_END
+
+
+def status_frame(seq, status, temperature, volume=1200):
+    return kettle_frame(calc_msg_checksum(
+        "aa00180300000000000000%02x360000c800%02x0000%02x64%04x0000"
+        % (seq, status, temperature, volume),
+        append=True,
+    ))
+
+
+def ack_frame(seq, cmd):
+    body = "aa000e00000000000003b7%02x%s0000c8" % (seq, cmd)
+    return kettle_frame(body + "%02x" % calc_msg_checksum(body + "00"))
+
+
+class StandIns:
+    """Stand-in kettle, MQTT broker and Home Assistant API, on their own thread and event loop"""
+
+    def __init__(self, hours, rate, mqtt, outage, ha=False):
+        self.total = int(hours * 3600)
+        self.rate = rate
+        self.mqtt = mqtt
+        self.outage = outage
+        self.sent = 0
+        self.publishes = 0
+        self.broker_down = False
+        self.broker_writers = set()
+        self.frames = [
+            status_frame(i % 256, status, temp) for i, (status, temp) in enumerate(BOIL_CYCLE)
+        ]
+        self.ha = ha
+        self.ha_states = {}  # entity_id -> state, as Home Assistant keeps them
+        self.ha_posts = Counter()
+        self.ha_requests = self.ha_connections = self.ha_events = 0
+        self.ha_refused = self.ha_late_refused = 0
+        self.ha_refused_at = None
+        self.ha_restarted = self.ha_refusing = False
+        self.ha_resumed = threading.Event()
+        self.ha_writers = set()
+        self.loop = asyncio.new_event_loop()
+        self.kettle_port = self.broker_port = self.ha_port = None
+        self.done = threading.Event()
+
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), daemon=True).start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        kettle = self.loop.run_until_complete(asyncio.start_server(self._kettle, "127.0.0.1", 0))
+        self.kettle_port = kettle.sockets[0].getsockname()[1]
+        if self.mqtt:
+            broker = self.loop.run_until_complete(asyncio.start_server(self._broker, "127.0.0.1", 0))
+            self.broker_port = broker.sockets[0].getsockname()[1]
+        if self.ha:
+            home_assistant = self.loop.run_until_complete(
+                asyncio.start_server(self._home_assistant, "127.0.0.1", 0)
+            )
+            self.ha_port = home_assistant.sockets[0].getsockname()[1]
+        ready.set()
+        self.loop.run_forever()
+
+    async def _kettle(self, reader, writer):
+        asyncio.ensure_future(self._kettle_commands(reader, writer))
+        start = time.monotonic()
+        cycle = len(self.frames)
+        outage = (self.total * (1 - self.outage) / 2, self.total * (1 + self.outage) / 2)
+        while self.sent < self.total:
+            for _ in range(SOAK_BATCH):
+                writer.write(self.frames[self.sent % cycle])
+                self.sent += 1
+            await writer.drain()
+            self.set_broker_down(outage[0] <= self.sent < outage[1])
+            if self.ha:
+                self.set_ha_phase(self.sent / self.total)
+            ahead = self.sent / self.rate - (time.monotonic() - start)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+        self.set_broker_down(False)
+        self.set_ha_phase(1.0)
+        self.done.set()
+
+    async def _kettle_commands(self, reader, writer):
+        try:
+            while True:
+                raw = await reader.readuntil(FRAME_END)
+                if raw == MSG_KEEP_CONNECT:
+                    writer.write(MSG_KEEP_CONNECT)
+                    continue
+                data2 = json.loads(raw[6:-2])["data2"]
+                writer.write(ack_frame(int(data2[22:24], 16), data2[24:26]))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError):
+            pass
+
+    def set_broker_down(self, down):
+        if down and not self.broker_down:
+            for writer in list(self.broker_writers):
+                writer.close()
+        self.broker_down = down
+
+    def set_ha_phase(self, progress):
+        if progress >= SOAK_HA_RESTART_AT and not self.ha_restarted:
+            self.ha_restarted = True
+            for writer in list(self.ha_writers):
+                writer.close()
+            self.ha_states.clear()
+        refusing = SOAK_HA_REFUSE[0] <= progress < SOAK_HA_REFUSE[1]
+        if self.ha_refusing and not refusing:
+            self.ha_resumed.set()
+        self.ha_refusing = refusing
+
+    async def _home_assistant(self, reader, writer):
+        """Just enough of Home Assistant's REST API for HomeAssistantBackend: POST /api/states/<id>
+        and /api/events/<type>, keep-alive, every other reply chunked
+        """
+        self.ha_connections += 1
+        self.ha_writers.add(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                path = lines[0].split(" ")[1]
+                headers = dict(
+                    (name.strip().lower(), value.strip())
+                    for name, value in (line.split(":", 1) for line in lines[1:] if ":" in line)
+                )
+                body = json.loads(await reader.readexactly(int(headers["content-length"])))
+                self.ha_requests += 1
+                if self.ha_refusing or headers.get("authorization") != "Bearer " + SOAK_HA_TOKEN:
+                    now = time.monotonic()
+                    if self.ha_refused_at is None:
+                        self.ha_refused_at = now
+                    elif now - self.ha_refused_at > 2 * HA_BATCH_SECS:
+                        self.ha_late_refused += 1
+                    self.ha_refused += 1
+                    status, reply = 401, b"401: Unauthorized"
+                elif path.startswith("/api/states/"):
+                    entity_id = path[len("/api/states/"):]
+                    status = 200 if entity_id in self.ha_states else 201
+                    self.ha_states[entity_id] = body["state"]
+                    self.ha_posts[entity_id] += 1
+                    reply = json.dumps({"entity_id": entity_id, "state": body["state"]}).encode()
+                elif path.startswith("/api/events/"):
+                    self.ha_events += 1
+                    status, reply = 200, b'{"message": "Event appkettle_event fired."}'
+                else:
+                    status, reply = 404, b"404: Not Found"
+                if self.ha_requests % 2:
+                    half = len(reply) // 2
+                    writer.write(
+                        b"HTTP/1.1 %d X\r\nTransfer-Encoding: chunked\r\n\r\n%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n"
+                        % (status, half, reply[:half], len(reply) - half, reply[half:])
+                    )
+                else:
+                    writer.write(b"HTTP/1.1 %d X\r\nContent-Length: %d\r\n\r\n" % (status, len(reply)) + reply)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            self.ha_writers.discard(writer)
+            writer.close()
+
+    async def _broker(self, reader, writer):
+        """Just enough MQTT 3.1.1 for paho: CONNACK, SUBACK, PUBACK and PINGRESP"""
+        if self.broker_down:
+            writer.close()
+            return
+        self.broker_writers.add(writer)
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 3:  # PUBLISH
+                    self.publishes += 1
+                    if header & 0x06:
+                        topic_len = int.from_bytes(body[:2], "big")
+                        writer.write(b"\x40\x02" + body[2 + topic_len:4 + topic_len])
+                elif packet_type == 8:  # SUBSCRIBE
+                    writer.write(b"\x90\x03" + body[:2] + b"\x00")
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14:  # DISCONNECT
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker_writers.discard(writer)
+            writer.close()
+
+
+async def soak(args, stand_ins):
+    calib = LevelCalibration(auto=True)
+    kettle_client = KettleClient("127.0.0.1", stand_ins.kettle_port, imei="SOAK", usage=KettleUsage(), calib=calib)
+    apply_debug_level(kettle_client, 0)
+    broker = ("127.0.0.1", stand_ins.broker_port, None, None) if stand_ins.mqtt else None
+    mqtt_bridge = MqttBridge(kettle_client, broker)
+    mqtt_bridge.connect()
+    backends = [mqtt_bridge]
+    ha_backend = None
+    if stand_ins.ha:
+        ha_backend = HomeAssistantBackend("http://127.0.0.1:%d" % stand_ins.ha_port, SOAK_HA_TOKEN)
+        backends.append(ha_backend)
+    daemon = KettleDaemon(kettle_client, backends)
+    daemon.history = KettleHistory(SOAK_HISTORY_SAMPLES)
+
+    handled = 0
+
+    def cb_frame(raw, msg, cmd_dict):
+        nonlocal handled
+        if cmd_dict is None or cmd_dict.get("cmd") != "STAT":
+            return False
+        handled += 1
+        if handled % len(BOIL_CYCLE) == 0:
+            asyncio.ensure_future(command(kettle_client.turn_on(trace=daemon.trace("on", "soak"))))
+        elif handled % len(BOIL_CYCLE) == len(BOIL_CYCLE) // 2:
+            asyncio.ensure_future(command(kettle_client.turn_off(trace=daemon.trace("off", "soak"))))
+        return False
+
+    async def command(coro):
+        with contextlib.suppress(asyncio.TimeoutError, ConnectionError):
+            await coro
+
+    async def ha_reload():
+        """Reloads the backend once the stand-in accepts the token again, as SIGHUP would"""
+        while not stand_ins.ha_resumed.is_set():
+            await asyncio.sleep(0.05)
+        await ha_backend.reload({})
+
+    kettle_client.frame_listeners.append(cb_frame)
+    daemon_task = asyncio.create_task(daemon.run())
+    if ha_backend is not None:
+        asyncio.ensure_future(ha_reload())
+
+    total = stand_ins.total
+    warmup_at = int(total * SOAK_WARMUP)
+    baseline = None
+    failures = []
+    start = last_time = time.monotonic()
+    last_cpu = time.thread_time()
+    last_handled = 0
+    for i in range(1, SOAK_REPORTS + 1):
+        target = warmup_at + (total - warmup_at) * i // SOAK_REPORTS
+        if baseline is None:
+            while handled < warmup_at:
+                await asyncio.sleep(0.05)
+            baseline = (rss_bytes(), object_census())
+            start = last_time = time.monotonic()
+            last_cpu = time.thread_time()
+            last_handled = handled
+        while handled < target and not (stand_ins.done.is_set() and handled >= stand_ins.sent):
+            await asyncio.sleep(0.05)
+        now, cpu = time.monotonic(), time.thread_time()
+        frames = max(1, handled - last_handled)
+        rate = frames / (now - last_time)
+        frame_us = (cpu - last_cpu) / frames * 1e6
+        rss = rss_bytes()
+        report(
+            "[SOAK] %5.1fh simulated | %7d frames | %6.0f frames/s | %5.1f us CPU/frame | RSS %.1fMB (%+.2fMB)"
+            " | MQTT publishes %d%s%s"
+            % (
+                handled / 3600, handled, rate, frame_us, rss / 2**20, (rss - baseline[0]) / 2**20,
+                stand_ins.publishes, " (broker down)" if stand_ins.broker_down else "",
+                " | HA requests %d" % stand_ins.ha_requests if stand_ins.ha else "",
+            )
+        )
+        if frame_us > args.max_frame_us:
+            failures.append("%.1f us CPU per frame (max %d)" % (frame_us, args.max_frame_us))
+        if rate < args.rate * args.min_rate_ratio and not stand_ins.done.is_set():
+            failures.append("%.0f frames/s (min %.0f)" % (rate, args.rate * args.min_rate_ratio))
+        last_time, last_cpu, last_handled = now, cpu, handled
+
+    census = object_census()
+    rss_growth = (rss_bytes() - baseline[0]) / 2**20
+    object_growth = sum(census.values()) - sum(baseline[1].values())
+    growth = (census - baseline[1]).most_common(5)
+    report("[SOAK] object growth after warm-up: %+d, most grown types: %s" % (object_growth, growth))
+    if rss_growth > args.max_rss_growth_mb:
+        failures.append("RSS grew %.1fMB (max %s)" % (rss_growth, args.max_rss_growth_mb))
+    if object_growth > args.max_object_growth:
+        failures.append("%d more live objects (max %d)" % (object_growth, args.max_object_growth))
+    if handled < total:
+        failures.append("only %d of %d frames handled" % (handled, total))
+    if ha_backend is not None:
+        failures += await check_home_assistant(stand_ins, ha_backend)
+
+    daemon_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await daemon_task
+    return failures
+
+
+async def check_home_assistant(stand_ins, ha_backend):
+    """Waits for the backend to catch up, then checks it against the Home Assistant stand-in"""
+    def pushed():
+        return {entity_id: state for entity_id, (state, _) in ha_backend.states.items()}
+
+    deadline = time.monotonic() + HA_RETRY_SECS + 4 * HA_BATCH_SECS
+    while time.monotonic() < deadline and (ha_backend.pending or pushed() != stand_ins.ha_states):
+        await asyncio.sleep(HA_BATCH_SECS)
+    report(
+        "[SOAK] HA: %d requests on %d connections, %d events, %d refused (%d after the first batch)"
+        % (
+            stand_ins.ha_requests, stand_ins.ha_connections, stand_ins.ha_events, stand_ins.ha_refused,
+            stand_ins.ha_late_refused,
+        )
+    )
+    failures = []
+    # the first connection, one after the restart and one after the reload
+    if stand_ins.ha_connections > 3:
+        failures.append("HA: %d connections (max 3)" % stand_ins.ha_connections)
+    refusal_secs = (SOAK_HA_REFUSE[1] - SOAK_HA_REFUSE[0]) * stand_ins.total / stand_ins.rate
+    if not stand_ins.ha_refused and refusal_secs > HA_RETRY_SECS + 1:
+        failures.append("HA: nothing was sent while the token was refused")
+    if stand_ins.ha_late_refused:
+        failures.append("HA: %d requests after the token was refused" % stand_ins.ha_late_refused)
+    if stand_ins.ha_posts[SOAK_HA_CONSTANT_ENTITY] > stand_ins.ha_connections:
+        failures.append(
+            "HA: unchanged %s sent %d times" % (SOAK_HA_CONSTANT_ENTITY, stand_ins.ha_posts[SOAK_HA_CONSTANT_ENTITY])
+        )
+    if ha_backend.pending or pushed() != stand_ins.ha_states:
+        missing = set(pushed()) ^ set(stand_ins.ha_states)
+        failures.append("HA: entity states out of sync with Home Assistant (differing entities: %s)" % missing)
+    return failures
+
+
+def argparser():
+    parser = argparse.ArgumentParser(description="Soak test for the appKettle daemon")
+    parser.add_argument("--hours", help="simulated hours (default 24)", default=SOAK_HOURS, type=float)
+    parser.add_argument("--rate", help="heartbeats per second (default 1000)", default=SOAK_RATE, type=int)
+    parser.add_argument("--no-mqtt", help="run without the broker stand-in", action="store_true")
+    parser.add_argument("--ha", help="also push to a Home Assistant API stand-in", action="store_true")
+    parser.add_argument("--outage", help="broker outage fraction (default 0.2)", default=0.2, type=float)
+    parser.add_argument("--max-rss-growth-mb", default=MAX_RSS_GROWTH_MB, type=float)
+    parser.add_argument("--max-object-growth", default=MAX_OBJECT_GROWTH, type=int)
+    parser.add_argument("--max-frame-us", default=MAX_FRAME_US, type=float)
+    parser.add_argument("--min-rate-ratio", default=MIN_RATE_RATIO, type=float)
+    args = parser.parse_args()
+
+    mqtt = not args.no_mqtt
+    if mqtt:
+        try:
+            import paho.mqtt.client  # noqa: F401  pip install paho-mqtt
+        except ImportError:
+            report("[SOAK] paho-mqtt is not installed, running without MQTT")
+            mqtt = False
+
+    stand_ins = StandIns(args.hours, args.rate, mqtt, args.outage, args.ha)
+    stand_ins.start()
+    report(
+        "[SOAK] %d heartbeats (%.1f simulated hours) at %d/s, MQTT %s, Home Assistant %s"
+        % (stand_ins.total, args.hours, args.rate, "on" if mqtt else "off", "on" if args.ha else "off")
+    )
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        failures = asyncio.run(soak(args, stand_ins))
+    for failure in failures:
+        report("[SOAK] FAIL:", failure)
+    report("[SOAK] PASS" if not failures else "[SOAK] %d check(s) failed" % len(failures))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    argparser()